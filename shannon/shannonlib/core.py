@@ -7,26 +7,236 @@ This module contains the main functions for computing population divergence
 using information-theoretic measures.
 """
 
+import json
 import os
 import logging
 from typing import Optional, Dict, List, Any
+import numpy as np
 import pandas as pd
 
 import shannonlib.estimators as est
 import shannonlib.gpf_utils as gpf
+import shannonlib.io as shio
+import shannonlib.summary as smry
 
 logger = logging.getLogger(__name__)
 
 
-def divergence(sample, chrom=None, data_columns=None, outfile=None, chunksize=None):
+def as_sample(sample):
+    """Return sample as dictionary of 'url' and 'label' lists.
+
+    Args:
+        sample: Dictionary or DataFrame containing 'url' and 'label'
+
+    Returns:
+        Dictionary with 'url' and 'label' keys
+
+    Raises:
+        ValueError: If sample is invalid
+    """
+    if isinstance(sample, pd.DataFrame):
+        if not {'url', 'label'}.issubset(sample.columns):
+            raise ValueError("Sample DataFrame must contain 'url' and 'label' columns")
+        sample = {
+            "url": list(sample["url"]),
+            "label": list(sample["label"])
+        }
+    elif isinstance(sample, dict):
+        if 'url' not in sample or 'label' not in sample:
+            raise ValueError("Sample dictionary must contain 'url' and 'label' keys")
+    else:
+        raise ValueError("Sample must be a dictionary or a DataFrame")
+
+    return sample
+
+
+def write_manifest(statsfile, manifest):
+    """Write the manifest of a sufficient statistics file next to it."""
+    with open(statsfile + '.json', 'w') as handle:
+        json.dump(manifest, handle, indent=2)
+
+
+def read_manifest(statsfile):
+    """Read the manifest of a sufficient statistics file."""
+    try:
+        with open(statsfile + '.json') as handle:
+            return json.load(handle)
+    except FileNotFoundError:
+        logger.error(f"Manifest not found for statistics file: {statsfile}")
+        raise
+
+
+def append_table(table, outfile):
+    """Append a table to a tab-separated file, writing the header once.
+
+    Args:
+        table: DataFrame to write
+        outfile: Output file path
+
+    Raises:
+        IOError: If output file cannot be written
+    """
+    if not os.path.isfile(outfile):
+        header = True
+    elif os.stat(outfile).st_size == 0:
+        header = True
+    else:
+        header = False
+
+    try:
+        table.to_csv(outfile, header=header, sep='\t', index=True, mode='a')
+        logger.debug(f"Results written to {outfile}")
+    except IOError as e:
+        logger.error(f"Failed to write to output file {outfile}: {e}")
+        raise
+
+
+def round_output(table, decimals=3):
+    """Round information-theoretic quantities and levels of a table."""
+    return table.round({column: decimals for column in table.columns
+                        if column.endswith('_bit_') or column == 'MET'})
+
+
+def select_units(data, units):
+    """Return the data of a subset of the sampling units.
+
+    Args:
+        data: DataFrame or gpf.SiteArray as yielded by gpf.get_data
+        units: Labels of the sampling units to keep
+
+    Returns:
+        Data of the same type restricted to units
+    """
+    if isinstance(data, gpf.SiteArray):
+        position = [data.units.index(unit) for unit in units]
+        return data._replace(counts=data.counts[:, position],
+                             valid=data.valid[:, position], units=list(units))
+    return data.loc[:, list(units)]
+
+
+def site_counts(data):
+    """Return the number of sites observed in any sampling unit per chrom."""
+    if isinstance(data, gpf.SiteArray):
+        chroms = data.chrom[data.valid.any(axis=1)]
+    else:
+        chroms = data.index.get_level_values('#chrom')[
+            data.notna().any(axis=1).to_numpy()]
+    return pd.Series(chroms, dtype=object).value_counts(sort=False)
+
+
+def aggregate_intervals(data, div, targets, min_count=3, min_samplesize=2,
+                        weights=None, metrics=None, groups=None):
+    """Aggregate per-site divergence over target intervals.
+
+    Sites are assigned to the interval that contains them. For each interval
+    with at least one site passing QC, this returns the metrics of the
+    pooled counts (summed over the interval's sites per sampling unit) along
+    with the mean per-site JSD and the number of sites.
+
+    Args:
+        data: Merged count data of the region, as yielded by gpf.get_data
+        div: Per-site divergence of the region, as returned by
+            est.js_divergence
+        targets: Non-overlapping intervals with '#chrom', 'start' and 'end'
+            columns (0-based, half-open)
+        min_count: QC threshold passed to est.js_divergence (default: 3)
+        min_samplesize: QC threshold passed to est.js_divergence (default: 2)
+        weights: Weights passed to est.js_divergence (default: None)
+        metrics: Metrics passed to est.js_divergence; per-unit entropies
+            ('H_unit') are not pooled (default: JSD and HMIX)
+        groups: Nested groups passed to est.js_divergence (optional)
+
+    Returns:
+        DataFrame indexed by interval ('#chrom', 'start', 'end')
+    """
+    sites = div.index.to_frame(index=False)
+    interval = np.full(len(sites), -1)
+
+    for chrom, group in sites.groupby('#chrom'):
+        chrom_targets = targets[targets['#chrom'] == chrom]
+        if chrom_targets.empty:
+            continue
+        starts = chrom_targets['start'].to_numpy()
+        ends = chrom_targets['end'].to_numpy()
+        position = group['start'].to_numpy()
+        # BED intervals are 0-based, half-open; GPF positions are 1-based
+        idx = np.searchsorted(starts, position, side='left') - 1
+        inside = (idx >= 0) & (position <= ends[np.clip(idx, 0, None)])
+        interval[group.index.to_numpy()] = np.where(
+            inside, chrom_targets.index.to_numpy()[idx], -1)
+
+    interval = pd.Series(interval, index=div.index)
+    interval = interval[interval >= 0]
+
+    if interval.empty:
+        return pd.DataFrame()
+
+    pooled = (data
+              .loc[interval.index]
+              .astype(np.float64)
+              .groupby(interval.to_numpy())
+              .sum(min_count=1))
+    if metrics is not None:
+        metrics = [metric for metric in metrics if metric != 'H_unit']
+    agg = est.js_divergence(
+        pooled, weights=weights, min_count=min_count,
+        min_samplesize=min_samplesize, metrics=metrics, groups=groups)
+
+    if agg.empty:
+        return agg
+
+    jsd = div.loc[interval.index, 'JSD_bit_'].groupby(interval.to_numpy())
+    agg.insert(1, 'mean JSD_bit_', jsd.mean())
+    agg.insert(2, 'num sites', jsd.size())
+    agg.index = pd.MultiIndex.from_frame(targets.loc[agg.index])
+
+    return agg
+
+
+def divergence(sample, chrom=None, data_columns=None, outfile=None, chunksize=None,
+               targets=None, interval_outfile=None, min_count=3,
+               min_samplesize=2, min_coverage=None, statsfile=None,
+               compact=False, weights=None, metrics=None, decompose=None,
+               summary=None, context='.', summary_by=None):
     """Computes within-group divergence for population.
     
     Args:
         sample: Dictionary containing 'url' and 'label' keys
-        chrom: Chromosome identifier (optional)
+        chrom: Chromosome identifier (optional if targets are given)
         data_columns: List of data columns to process (optional)
         outfile: Output file path (optional)
         chunksize: Expected number of sites per chunk (optional)
+        targets: BED file of target intervals; only sites within the
+            (merged) intervals are processed (optional)
+        interval_outfile: Output file path for per-interval aggregates,
+            requires targets (optional)
+        min_count: Minimum total count that at least one sampling unit must
+            reach at a site (default: 3)
+        min_samplesize: Minimum number of sampling units observed at a site
+            (default: 2)
+        min_coverage: Minimum total count of a sampling unit at a site; sites
+            below are treated as unobserved in that unit (optional)
+        statsfile: Output file path for per-site sufficient statistics, which
+            can be updated with new or removed samples by update (optional)
+        compact: Use compact data types (int32 positions, unsigned integer
+            counts with validity mask, float32 entropies); see
+            est.js_divergence for the precision impact (default: False)
+        weights: Weights of the sampling units, see est.js_divergence
+            (default: None, i.e. total counts)
+        metrics: List of metrics written per site, see est.js_divergence
+            (default: ['JSD', 'HMIX'])
+        decompose: List of factors, ordered from outermost to innermost, by
+            which JSD is decomposed into between- and within-group parts;
+            sample must hold a column or key per factor (optional)
+        summary: Output file path for a summary of the metrics by
+            chromosome, context and group, see smry.write_summary; it is
+            accumulated region by region, so outfile can be omitted
+            (optional)
+        context: Context label of the summary, e.g. CG (default: '.')
+        summary_by: Factor whose groups are summarised in addition to the
+            whole population, with JSD computed among the sampling units of
+            each group; sample must hold a column or key of that name
+            (optional)
         
     Returns:
         None
@@ -38,24 +248,58 @@ def divergence(sample, chrom=None, data_columns=None, outfile=None, chunksize=No
     """
     logger.info(f"Starting divergence computation for chromosome: {chrom}")
     
-    if isinstance(sample, pd.DataFrame):
-        if not {'url', 'label'}.issubset(sample.columns):
-            raise ValueError("Sample DataFrame must contain 'url' and 'label' columns")
-        sample = {
-            "url": list(sample["url"]),
-            "label": list(sample["label"])
-        }
-    elif isinstance(sample, dict):
-        if 'url' not in sample or 'label' not in sample:
-            raise ValueError("Sample dictionary must contain 'url' and 'label' keys")
+    if decompose is not None:
+        try:
+            groups = {factor: dict(zip(sample['label'], sample[factor]))
+                      for factor in decompose}
+        except KeyError as e:
+            raise ValueError(f"Sample must contain the decomposition factor {e}")
     else:
-        raise ValueError("Sample must be a dictionary or a DataFrame")
+        groups = None
+
+    if summary_by is not None:
+        try:
+            levels = pd.Series(list(sample[summary_by]), index=list(sample['label']))
+        except KeyError as e:
+            raise ValueError(f"Sample must contain the summary factor {e}")
+        subsets = {f'{summary_by}={level}': list(levels.index[levels == level])
+                   for level in pd.unique(levels)}
+    else:
+        subsets = {}
+
+    sample = as_sample(sample)
     
+    if interval_outfile is not None and targets is None:
+        raise ValueError("Per-interval output requires target intervals")
+
+    if interval_outfile is not None and metrics is not None and 'JSD' not in metrics:
+        raise ValueError("Per-interval output requires the 'JSD' metric")
+
+    if statsfile is not None:
+        if targets is not None:
+            raise ValueError("Sufficient statistics are not supported with targets")
+        if chrom is None:
+            raise ValueError("Sufficient statistics require a chromosome")
+        write_manifest(statsfile, {
+            'chrom': chrom,
+            'label': sample['label'],
+            'url': sample['url'],
+            'data_columns': [[col, name, dtype.__name__]
+                             for col, name, dtype in data_columns[0]],
+            'min_count': min_count,
+            'min_coverage': min_coverage
+        })
+
     try:
         # Get regions for processing
         logger.debug(f"Getting regions for sample: {sample}")
-        regions_result = gpf.get_regions(
-            sample['url'], chrom=chrom, exp_numsites=chunksize)
+        if targets is not None:
+            intervals = shio.target_reader(targets, chrom=chrom)
+            regions_result = gpf.get_target_regions(
+                intervals, exp_numsites=chunksize)
+        else:
+            regions_result = gpf.get_regions(
+                sample['url'], chrom=chrom, exp_numsites=chunksize)
         
         if not regions_result:
             logger.warning("No regions found, skipping divergence computation")
@@ -74,12 +318,23 @@ def divergence(sample, chrom=None, data_columns=None, outfile=None, chunksize=No
             sample['url'], 
             labels=sample['label'],
             data_columns=data_columns, 
-            regions=regions
+            regions=regions,
+            min_coverage=min_coverage,
+            # keep all sites when storing statistics for later updates or
+            # counting the sites read for the summary; js_divergence
+            # applies min_samplesize itself
+            min_samplesize=None if statsfile or summary else min_samplesize,
+            compact=compact,
+            # statistics and interval aggregates are computed on data frames
+            engine='concat' if statsfile or interval_outfile else 'sorted'
         )
 
         processed_count = 0
         skipped_empty = 0
         skipped_quality = 0
+
+        if summary is not None:
+            report = smry.Summary()
         
         for progress, data in zip(regions_pct, regions_data):
             try:
@@ -89,9 +344,28 @@ def divergence(sample, chrom=None, data_columns=None, outfile=None, chunksize=No
                     skipped_empty += 1
                     continue
 
+                if statsfile:
+                    # update reads the statistics in coordinate order
+                    stats = est.sufficient_statistics(data, min_count=min_count)
+                    append_table(stats.sort_index(), statsfile)
+
                 # Compute divergence
                 logger.debug(f"Computing JS divergence for region at {progress}%")
-                div = est.js_divergence(data)
+                div = est.js_divergence(
+                    data, weights=weights, min_count=min_count,
+                    min_samplesize=min_samplesize, compact=compact,
+                    metrics=metrics, groups=groups)
+
+                if summary is not None:
+                    report.update(div, site_counts(data), context=context)
+                    for group, units in subsets.items():
+                        subset = select_units(data, units)
+                        report.update(
+                            est.js_divergence(
+                                subset, weights=weights, min_count=min_count,
+                                min_samplesize=min_samplesize, compact=compact,
+                                metrics=metrics, groups=groups),
+                            site_counts(subset), context=context, group=group)
 
                 if div.empty:
                     logger.debug(f"Skipping low-quality region at {progress}%")
@@ -101,23 +375,15 @@ def divergence(sample, chrom=None, data_columns=None, outfile=None, chunksize=No
 
                 # output file
                 if outfile:
-                    try:
-                        if not os.path.isfile(outfile):
-                            header = True
-                        elif os.stat(outfile).st_size == 0:
-                            header = True
-                        else:
-                            header = False
-
-                        (div
-                         .round({'JSD_bit_': 3, 'HMIX_bit_': 3})
-                         .to_csv(outfile, header=header, sep='\t', index=True, mode='a'))
-                        
-                        logger.debug(f"Results written to {outfile}")
-                        
-                    except IOError as e:
-                        logger.error(f"Failed to write to output file {outfile}: {e}")
-                        raise
+                    append_table(round_output(div), outfile)
+
+                if interval_outfile:
+                    agg = aggregate_intervals(
+                        data, div, intervals, min_count=min_count,
+                        min_samplesize=min_samplesize, weights=weights,
+                        metrics=metrics, groups=groups)
+                    if not agg.empty:
+                        append_table(round_output(agg), interval_outfile)
 
                 print('...{:>5} %'.format(progress))
                 processed_count += 1
@@ -129,9 +395,139 @@ def divergence(sample, chrom=None, data_columns=None, outfile=None, chunksize=No
 
         logger.info(f"Divergence computation completed. Processed: {processed_count}, "
                    f"Skipped empty: {skipped_empty}, Skipped low-quality: {skipped_quality}")
+
+        if summary is not None:
+            smry.write_summary(report, summary)
         
     except Exception as e:
         logger.error(f"Fatal error in divergence computation: {e}")
         raise
 
-    return None
\ No newline at end of file
+    return None
+
+
+def update(statsfile, add=None, remove=None, outfile=None, stats_outfile=None,
+           chunksize=None, min_samplesize=2):
+    """Updates population divergence for added or removed samples.
+
+    Reads the sufficient statistics written by divergence and only the
+    files of the added or removed samples, so the cost grows with the
+    number of changed samples rather than the cohort size.
+
+    Args:
+        statsfile: Sufficient statistics file written by divergence
+        add: Dictionary or DataFrame with 'url' and 'label' of samples to
+            add (optional)
+        remove: Dictionary or DataFrame with 'url' and 'label' of samples to
+            remove; the files must be unchanged since they were added
+            (optional)
+        outfile: Output file path (optional)
+        stats_outfile: Output file path for the updated statistics (optional)
+        chunksize: Number of stored sites per chunk (optional)
+        min_samplesize: Minimum number of sampling units observed at a site
+            (default: 2)
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If samples are invalid or output overwrites input
+        FileNotFoundError: If input files cannot be found
+        IOError: If output file cannot be written
+    """
+    manifest = read_manifest(statsfile)
+    chrom = manifest['chrom']
+    logger.info(f"Starting divergence update for chromosome: {chrom}")
+
+    if stats_outfile is not None and os.path.abspath(stats_outfile) == os.path.abspath(statsfile):
+        raise ValueError("Updated statistics cannot overwrite the input statistics")
+
+    changes = []
+    labels = list(manifest['label'])
+    urls = list(manifest['url'])
+
+    if remove is not None:
+        remove = as_sample(remove)
+        missing = set(remove['label']) - set(labels)
+        if missing:
+            raise ValueError(f"Samples to remove are not in statistics: {sorted(missing)}")
+        keep = [i for i, label in enumerate(labels) if label not in remove['label']]
+        labels = [labels[i] for i in keep]
+        urls = [urls[i] for i in keep]
+        changes.append((remove, -1))
+
+    if add is not None:
+        add = as_sample(add)
+        present = set(add['label']) & set(labels)
+        if present:
+            raise ValueError(f"Samples to add are already in statistics: {sorted(present)}")
+        labels += add['label']
+        urls += add['url']
+        changes.append((add, 1))
+
+    data_columns = [[(col, name, {'int': int, 'float': float}[dtype])
+                     for col, name, dtype in manifest['data_columns']]]
+    min_count = manifest['min_count']
+    index = ['#chrom', 'start', 'end']
+
+    def changed_statistics(region):
+        # statistics of the changed samples with sign of the change
+        parts = []
+        for change, sign in changes:
+            data = next(gpf.get_data(
+                change['url'], labels=change['label'],
+                data_columns=data_columns, regions=[region],
+                min_coverage=manifest['min_coverage']))
+            if not data.empty:
+                parts.append(sign * est.sufficient_statistics(data, min_count=min_count))
+        return parts
+
+    def merge(stored, parts):
+        merged = stored
+        for part in parts:
+            merged = merged.add(part, fill_value=0)
+        merged = merged[merged['sample size'] > 0].sort_index()
+        integer = [c for c in merged.columns if c != 'WH_nat_']
+        return merged.astype({c: np.int64 for c in integer})
+
+    def emit(merged, progress):
+        if merged.empty:
+            print('...{} (skipped empty region)'.format(progress))
+            return
+        if stats_outfile:
+            append_table(merged, stats_outfile)
+        div = est.js_divergence_from_statistics(merged, min_samplesize=min_samplesize)
+        if outfile and not div.empty:
+            append_table(round_output(div), outfile)
+        print('...{}'.format(progress))
+
+    # the changed samples are queried over contiguous ranges ending at the
+    # last stored site of each chunk, then up to their last site
+    last = 0
+    reader = shio.bedcount_reader(statsfile, chunksize=int(chunksize or 1e4))
+    stored = None
+    for stored in reader:
+        stored = stored.set_index(index)
+        end = int(stored.index.get_level_values('start').max())
+        region = (chrom, last + 1, end)
+        emit(merge(stored, changed_statistics(region)),
+             '{}:{}-{}'.format(*region))
+        last = end
+
+    if add is not None:
+        sup_position = gpf.supremum_position(add['url'], chrom)
+        if sup_position is not None and sup_position > last:
+            region = (chrom, last + 1, int(sup_position))
+            empty = pd.DataFrame(
+                columns=(stored.columns if stored is not None else None),
+                index=pd.MultiIndex.from_arrays([[], [], []], names=index))
+            emit(merge(empty, changed_statistics(region)),
+                 '{}:{}-{}'.format(*region))
+
+    if stats_outfile:
+        manifest.update({'label': labels, 'url': urls})
+        write_manifest(stats_outfile, manifest)
+
+    logger.info("Divergence update completed")
+
+    return None
@@ -14,19 +14,22 @@ import numpy as np
 import pandas as pd
 
 import shannonlib.constants as constant
+from shannonlib.gpf_utils import SiteArray
 
 
 logger = logging.getLogger(__name__)
 
 
 def shannon_entropy(countmatrix: np.ndarray, axis: int = 1, 
-                   method: str = 'plug-in') -> np.ndarray:
+                   method: str = 'plug-in', dtype: Any = np.float64) -> np.ndarray:
     """Shannon entropy (in nat) of the feature frequency profile.
     
     Args:
         countmatrix: Count matrix for computing entropy
         axis: Axis along which to compute entropy (default: 1)
         method: Method for entropy estimation (default: 'plug-in')
+        dtype: Floating point type of probabilities and entropies
+            (default: np.float64)
         
     Returns:
         Array of Shannon entropy values
@@ -51,10 +54,10 @@ def shannon_entropy(countmatrix: np.ndarray, axis: int = 1,
             
             # Avoid division by zero
             if np.any(count_distribution == 0):
-                logger.warning("Zero count distributions detected")
+                logger.debug("Zero count distributions detected")
                 count_distribution = np.where(count_distribution == 0, 1, count_distribution)
             
-            prob = countmatrix / count_distribution
+            prob = np.divide(countmatrix, count_distribution, dtype=dtype)
             result = ne.evaluate(expression)
             
             logger.debug(f"Shannon entropy computed successfully, shape: {result.shape}")
@@ -66,81 +69,237 @@ def shannon_entropy(countmatrix: np.ndarray, axis: int = 1,
 
 
 
-def js_divergence(indata, weights=None):
+METRICS = ['JSD', 'HMIX', 'JSD_uniform', 'MET', 'H_unit']
+
+
+def js_divergence(indata, weights=None, min_count=3, min_samplesize=2,
+                  compact=False, metrics=None, groups=None):
     """
     Compute Jensen-Shannon divergence.
+
+    All requested metrics are computed in one pass over the filtered count
+    array and share its intermediates: per-unit totals, per-unit entropies
+    and the mixture distribution. Available metrics are
+
+    - 'JSD': JS divergence of the units under the given weights ('JSD_bit_')
+    - 'HMIX': entropy of the mixture under the given weights ('HMIX_bit_')
+    - 'JSD_uniform': JS divergence with equal weights ('JSD_uniform_bit_')
+    - 'MET': fraction of the first feature in the pooled counts, i.e. the
+      count-weighted mean methylation level ('MET')
+    - 'H_unit': entropy of each unit ('H_<unit>_bit_', NaN if unobserved)
+
+    Units with zero total count carry no distribution and get zero weight.
+
+    If groups are given, the JS divergence under the given weights is
+    decomposed into a between-group part for each (nested) factor and a
+    within-group part, which add up to the total JSD:
+
+    - 'JSD_between_<factor>_bit_': entropy of the mixtures of the enclosing
+      groups minus the weighted entropy of the mixtures of the groups nested
+      by factor
+    - 'JSD_within_bit_': weighted entropy of the mixtures of the innermost
+      groups minus the weighted entropy of the units
     
     Args:
-        indata: Input data frame
-        weights: Optional weights for averaging (currently unused)
+        indata: Input data frame, or SiteArray as yielded by
+            gpf.get_data(engine='sorted'), whose arrays are used directly
+        weights: Weights of the sampling units; 'count' (or None) for their
+            total counts, 'uniform' for equal weights or a sequence with one
+            weight per unit (default: None)
+        min_count: Minimum total count that at least one sampling unit must
+            reach at a site (default: 3)
+        min_samplesize: Minimum number of sampling units observed at a site
+            (default: 2)
+        compact: Input holds nullable unsigned integer counts as read by
+            gpf.get_data(compact=True); counts are processed as uint32 with
+            a validity mask and probabilities and entropies as float32, which
+            changes JSD and HMIX by less than 1e-6 bit, well below the 3
+            decimals written by core.divergence (default: False)
+        metrics: List of metrics to compute (default: ['JSD', 'HMIX'])
+        groups: Dictionary mapping factors, ordered from outermost to
+            innermost, to dictionaries of sampling unit to level; e.g.
+            {'ecotype': {...}, 'tissue': {...}} for tissue within ecotype
+            (optional)
         
     Returns:
-        DataFrame with divergence results
+        DataFrame with divergence results; the 'sample size' and pooled
+        feature columns are always included
         
     Raises:
-        ValueError: If input data is invalid
+        ValueError: If input data, weights or metrics are invalid
         RuntimeError: If divergence computation fails
 
     """
 
     logger.debug("Starting JSD computation")
-    logger.debug(f"Input shape: {indata.shape}")
-    logger.debug(f"Input columns: {indata.columns}")
-
-    if not isinstance(indata.columns, pd.MultiIndex):
-        logger.warning("Input does not have a MultiIndex — attempting to reconstruct it")
-        n_cols = indata.shape[1]
-        if n_cols % 2 != 0:
-            raise ValueError(f"Expected even number of columns (mC/C pairs), got {n_cols}")
-
-        n_units = n_cols // 2
-        units = [f'unit_{i+1}' for i in range(n_units)]
-        features = ['mC', 'C']
-        indata.columns = pd.MultiIndex.from_product(
-            [units, features], names=['sampling_unit', 'feature']
-        )
-        logger.debug(f"Reconstructed MultiIndex: {indata.columns}")
+
+    metrics = ['JSD', 'HMIX'] if metrics is None else list(metrics)
+    unknown = set(metrics) - set(METRICS)
+    if unknown:
+        raise ValueError(f"Unsupported metrics: {sorted(unknown)}. "
+                         f"Choose from {METRICS}.")
+
+    if isinstance(indata, SiteArray):
+        logger.debug(f"Input shape: {indata.counts.shape}")
+        units = indata.units
+        features = indata.features
+        shape = indata.counts.shape
+    else:
+        logger.debug(f"Input shape: {indata.shape}")
+        logger.debug(f"Input columns: {indata.columns}")
+
+        if not isinstance(indata.columns, pd.MultiIndex):
+            logger.warning("Input does not have a MultiIndex — attempting to reconstruct it")
+            n_cols = indata.shape[1]
+            if n_cols % 2 != 0:
+                raise ValueError(f"Expected even number of columns (mC/C pairs), got {n_cols}")
+
+            n_units = n_cols // 2
+            units = [f'unit_{i+1}' for i in range(n_units)]
+            features = ['mC', 'C']
+            indata.columns = pd.MultiIndex.from_product(
+                [units, features], names=['sampling_unit', 'feature']
+            )
+            logger.debug(f"Reconstructed MultiIndex: {indata.columns}")
+
+        units = indata.columns.get_level_values('sampling_unit').unique()
+        features = indata.columns.get_level_values('feature').unique()
+        shape = (indata.shape[0], len(units), len(features))
+
+    if weights is None or isinstance(weights, str):
+        if weights not in (None, 'count', 'uniform'):
+            raise ValueError(f"Unsupported weights: {weights}")
+    elif len(weights) != len(units):
+        raise ValueError("Number of weights and sampling units must match")
+
+    if groups is not None:
+        try:
+            levels = [[mapping[unit] for unit in units]
+                      for mapping in groups.values()]
+        except KeyError as e:
+            raise ValueError(f"Sampling unit without group: {e}")
+
+    # counts of unobserved units are zero and flagged in the validity mask
+    dtype = np.float32 if compact else np.float64
+    count_dtype = np.uint32 if compact else np.float64
+    if isinstance(indata, SiteArray):
+        counts = indata.counts.astype(count_dtype, copy=False)
+        valid = indata.valid
+    else:
+        counts = indata.to_numpy(dtype=count_dtype, na_value=0).reshape(shape)
+        valid = indata.notna().to_numpy().reshape(shape).any(axis=2)
 
     # Compute total methylation count per sample
-    count_per_unit = indata.sum(axis=1, level='sampling_unit')
-    samplesize = count_per_unit.notnull().sum(axis=1)
+    count_per_unit = counts.sum(axis=2, dtype=counts.dtype)
+    samplesize = valid.sum(axis=1)
 
     # Apply QC filters
-    min_samplesize = 2
-    min_count = 3
-    count_filter = (count_per_unit >= min_count).any(axis=1)
+    count_filter = ((count_per_unit >= min_count) & valid).any(axis=1)
     samplesize_filter = (samplesize >= min_samplesize)
     combined_filter = (count_filter & samplesize_filter)
-    data = indata[combined_filter]
 
-    logger.debug(f"Rows before filtering: {len(indata)}")
-    logger.debug(f"Rows after filtering: {len(data)}")
+    logger.debug(f"Rows before filtering: {shape[0]}")
+    logger.debug(f"Rows after filtering: {combined_filter.sum()}")
 
-    if data.empty:
+    if not combined_filter.any():
         logger.warning("No data passed QC filtering — returning empty DataFrame")
-        return data
+        if isinstance(indata, SiteArray):
+            return pd.DataFrame()
+        return indata[combined_filter]
+
+    if isinstance(indata, SiteArray):
+        index = indata.site_index(combined_filter)
+    else:
+        index = indata.index[combined_filter]
 
-    # Entropy computation
     try:
-        data_unit = count_per_unit[combined_filter]
-        data_feature = (data.sum(axis=1, level='feature').astype(np.int32))
-        counts = data.values.reshape(
-            data_unit.shape[0],
-            data_unit.shape[1],
-            data_feature.shape[1]
-        )
-
-        mix_entropy = shannon_entropy(data_feature.values)
-        avg_entropy = np.average(
-            shannon_entropy(counts, axis=2),
-            weights=data_unit.fillna(0),
-            axis=1
-        )
-
-        div = data_feature.copy()
-        div.insert(0, 'JSD_bit_', constant.LOG2E * (mix_entropy - avg_entropy))
-        div.insert(1, 'sample size', samplesize[combined_filter])
-        div.insert(2, 'HMIX_bit_', constant.LOG2E * mix_entropy)
+        counts = counts[combined_filter]
+        valid = valid[combined_filter]
+        count_per_unit = count_per_unit[combined_filter]
+        data_feature = counts.sum(axis=1, dtype=counts.dtype)
+        log2e = dtype(constant.LOG2E)
+
+        div = pd.DataFrame(
+            data_feature.astype(np.uint32 if compact else np.int32),
+            columns=features, index=index)
+        div.insert(0, 'sample size', samplesize[combined_filter])
+
+        count_weights = weights is None or (isinstance(weights, str) and
+                                            weights == 'count')
+        observed = count_per_unit > 0
+
+        decompose = groups is not None
+
+        if {'JSD', 'JSD_uniform', 'H_unit'} & set(metrics) or decompose:
+            unit_entropy = shannon_entropy(counts, axis=2, dtype=dtype)
+
+        if 'JSD_uniform' in metrics or not count_weights:
+            unit_prob = np.divide(
+                counts, np.maximum(count_per_unit, 1)[..., np.newaxis],
+                dtype=dtype)
+
+        if {'JSD', 'HMIX'} & set(metrics) or decompose:
+            if count_weights:
+                unit_weights = count_per_unit
+                mixture = data_feature
+            else:
+                if isinstance(weights, str) and weights == 'uniform':
+                    unit_weights = observed
+                else:
+                    unit_weights = np.asarray(weights, dtype=dtype) * observed
+                mixture = (unit_weights[..., np.newaxis] * unit_prob).sum(axis=1)
+            mix_entropy = shannon_entropy(mixture, dtype=dtype)
+
+        if 'JSD' in metrics or decompose:
+            total_weight = unit_weights.sum(axis=1, dtype=dtype)
+            weighted_avg_entropy = ((unit_weights * unit_entropy)
+                                    .sum(axis=1, dtype=dtype) / total_weight)
+
+        if 'JSD' in metrics:
+            div.insert(0, 'JSD_bit_', log2e * (mix_entropy - weighted_avg_entropy))
+
+        if 'HMIX' in metrics:
+            div.insert(div.columns.get_loc('sample size') + 1,
+                       'HMIX_bit_', log2e * mix_entropy)
+
+        if 'JSD_uniform' in metrics:
+            uniform_entropy = shannon_entropy(
+                (observed[..., np.newaxis] * unit_prob).sum(axis=1), dtype=dtype)
+            uniform_avg_entropy = (unit_entropy.sum(axis=1, dtype=dtype)
+                                   / observed.sum(axis=1))
+            div['JSD_uniform_bit_'] = log2e * (uniform_entropy - uniform_avg_entropy)
+
+        if 'MET' in metrics:
+            div['MET'] = np.divide(
+                data_feature[:, 0], data_feature.sum(axis=1), dtype=dtype)
+
+        if decompose:
+            if count_weights:
+                # count-weighted probabilities are the counts themselves
+                weighted_prob = counts
+            else:
+                weighted_prob = unit_weights[..., np.newaxis] * unit_prob
+            outer_entropy = mix_entropy
+            for depth, factor in enumerate(groups):
+                # nested groups are the combinations of levels down to factor
+                keys = list(zip(*levels[:depth + 1]))
+                _, code = np.unique(
+                    np.array([str(key) for key in keys]), return_inverse=True)
+                indicator = np.eye(code.max() + 1, dtype=dtype)[code]
+                group_weight = unit_weights @ indicator
+                group_mixture = np.einsum(
+                    'suf,ug->sgf', weighted_prob, indicator)
+                group_entropy = ((group_weight *
+                                  shannon_entropy(group_mixture, axis=2, dtype=dtype))
+                                 .sum(axis=1, dtype=dtype) / total_weight)
+                div[f'JSD_between_{factor}_bit_'] = log2e * (outer_entropy - group_entropy)
+                outer_entropy = group_entropy
+            div['JSD_within_bit_'] = log2e * (outer_entropy - weighted_avg_entropy)
+
+        if 'H_unit' in metrics:
+            unit_entropy = np.where(observed, log2e * unit_entropy, np.nan)
+            for i, unit in enumerate(units):
+                div[f'H_{unit}_bit_'] = unit_entropy[:, i]
 
         logger.debug(f"JSD computation completed for {len(div)} rows")
         return div
@@ -148,3 +307,82 @@ def js_divergence(indata, weights=None):
     except Exception as e:
         logger.error(f"JSD computation failed: {e}")
         raise RuntimeError(f"JSD divergence computation failed: {e}")
+
+
+STATISTICS = ['count', 'sample size', 'units passing QC', 'WH_nat_']
+
+
+def sufficient_statistics(indata, min_count=3):
+    """Per-site sufficient statistics of the count-weighted JS divergence.
+
+    The statistics are additive over sampling units, so statistics of
+    disjoint sets of units can be summed (or subtracted) to obtain those of
+    their union (or difference) without revisiting the other units.
+
+    Args:
+        indata: Input data frame with (sampling_unit, feature) columns
+        min_count: Count threshold used for 'units passing QC' (default: 3)
+
+    Returns:
+        DataFrame with pooled feature counts, total 'count', 'sample size',
+        number of 'units passing QC' and the count-weighted sum of unit
+        entropies 'WH_nat_' (in nat)
+    """
+    logger.debug(f"Computing sufficient statistics for {len(indata)} rows")
+
+    count_per_unit = (indata
+                      .groupby(axis=1, level='sampling_unit', sort=False)
+                      .sum(min_count=1))
+    data_feature = (indata
+                    .groupby(axis=1, level='feature', sort=False)
+                    .sum()
+                    .astype(np.int64))
+    counts = indata.to_numpy(dtype=np.float64, na_value=np.nan).reshape(
+        count_per_unit.shape[0],
+        count_per_unit.shape[1],
+        data_feature.shape[1]
+    )
+    unit_weights = count_per_unit.fillna(0).values
+
+    stats = data_feature.copy()
+    stats['count'] = unit_weights.sum(axis=1).astype(np.int64)
+    stats['sample size'] = count_per_unit.notnull().sum(axis=1)
+    stats['units passing QC'] = (count_per_unit >= min_count).sum(axis=1)
+    stats['WH_nat_'] = (unit_weights * shannon_entropy(counts, axis=2)).sum(axis=1)
+
+    return stats
+
+
+def js_divergence_from_statistics(stats, min_samplesize=2):
+    """
+    Compute Jensen-Shannon divergence from sufficient statistics.
+
+    The result equals js_divergence applied to the units the statistics were
+    accumulated from, with the min_count used in sufficient_statistics.
+
+    Args:
+        stats: Data frame as returned by sufficient_statistics
+        min_samplesize: Minimum number of sampling units observed at a site
+            (default: 2)
+
+    Returns:
+        DataFrame with divergence results
+    """
+    combined_filter = ((stats['units passing QC'] > 0) &
+                       (stats['sample size'] >= min_samplesize))
+    data = stats[combined_filter]
+
+    if data.empty:
+        logger.warning("No data passed QC filtering — returning empty DataFrame")
+        return data
+
+    data_feature = data.drop(columns=STATISTICS).astype(np.int32)
+    mix_entropy = shannon_entropy(data_feature.values)
+    avg_entropy = data['WH_nat_'].values / data['count'].values
+
+    div = data_feature.copy()
+    div.insert(0, 'JSD_bit_', constant.LOG2E * (mix_entropy - avg_entropy))
+    div.insert(1, 'sample size', data['sample size'].astype(np.int64))
+    div.insert(2, 'HMIX_bit_', constant.LOG2E * mix_entropy)
+
+    return div
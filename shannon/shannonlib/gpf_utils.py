@@ -8,13 +8,17 @@ This module provides utilities for working with tabix-indexed genome position
 files, including region extraction and data merging.
 """
 
+import io
 import logging
 import math
+import os
 import subprocess
-from typing import List, Tuple, Optional, Union, Generator, Any
+from collections import OrderedDict
+from typing import List, Tuple, Optional, Union, Generator, Any, NamedTuple
 
 import numpy as np
 import pandas as pd
+from numpy.lib.stride_tricks import as_strided
 
 
 class InputMismatchError(Exception):
@@ -97,22 +101,553 @@ def get_regions(tabixfiles: Union[str, List[str]], chrom: Optional[str] = None,
         raise RuntimeError(f"Failed to get regions: {e}")
 
 
-def get_data(files: List[str], labels: Optional[List[str]] = None, 
+def get_target_regions(targets: pd.DataFrame,
+                       exp_numsites: float = 1e3) -> Union[Tuple[List[float], List[List[Tuple]]], bool]:
+    """Get batches of tabix regions covering target intervals.
+
+    Consecutive intervals on the same chromosome are batched until their
+    total length exceeds exp_numsites, which bounds the number of sites per
+    batch without scanning the input files. An interval is never split
+    across batches.
+
+    Args:
+        targets: Non-overlapping intervals with '#chrom', 'start' and 'end'
+            columns (0-based, half-open), e.g. from io.target_reader
+        exp_numsites: Expected number of sites per batch (default: 1000)
+
+    Returns:
+        Tuple of (progress_percentages, regions) or False if no targets,
+        where each region is a list of 1-based, closed (chrom, start, end)
+        tuples
+
+    Raises:
+        RuntimeError: If region computation fails
+    """
+    logger.debug(f"Getting regions for {len(targets)} target intervals")
+
+    if targets is None or len(targets) == 0:
+        logger.info("Skipping because there are no target intervals.")
+        return False
+
+    try:
+        chroms = targets['#chrom'].to_numpy()
+        starts = targets['start'].to_numpy()
+        ends = targets['end'].to_numpy()
+        total = int((ends - starts).sum())
+
+        progress = []
+        regions = []
+        batch = []
+        batch_length = 0
+        covered = 0
+
+        for chrom, start, end in zip(chroms, starts, ends):
+            if batch and (chrom != batch[-1][0] or batch_length >= exp_numsites):
+                progress.append(round(100 * covered / total, 1))
+                regions.append(batch)
+                batch = []
+                batch_length = 0
+            batch.append((chrom, int(start) + 1, int(end)))
+            batch_length += end - start
+            covered += end - start
+
+        progress.append(round(100 * covered / total, 1))
+        regions.append(batch)
+
+        logger.info(f"Generated {len(regions)} target batches for processing")
+        return progress, regions
+
+    except Exception as e:
+        logger.error(f"Error getting target regions: {e}")
+        raise RuntimeError(f"Failed to get target regions: {e}")
+
+
+# widest integer field handled by parse_bed (exact in float64 arithmetic)
+MAX_DIGITS = 13
+
+
+def bed_record(raw: bytes, position: int) -> bytes:
+    """Return a record of raw bytes by its 0-based position."""
+    return raw.split(b'\n')[position]
+
+
+def parse_bed(raw: bytes, columns: List[Tuple]) -> dict:
+    """Parse tab-separated records with a fixed number of fields.
+
+    Specialised for the output of tabix on bismark coverage files (chrom,
+    start, end, percent, mC, C), which would otherwise go through the
+    general-purpose pd.read_table. Field boundaries are located once in the
+    raw bytes; each requested integer column is then decoded by gathering
+    its right-aligned digits into a small matrix and reducing it with powers
+    of ten. Only the requested columns are decoded.
+
+    Args:
+        raw: Raw bytes of the records; lines starting with '#' are ignored
+        columns: List of (column, name, dtype) tuples with 0-based column
+            numbers; dtype str gives strings, float gives float64 and any
+            other dtype non-negative integers
+
+    Returns:
+        Dictionary of name to array in the order of columns
+
+    Raises:
+        ValueError: If records are ragged or integer fields hold non-digits;
+            the message quotes the first malformed record
+    """
+    if b'\r' in raw:
+        # CRLF line endings
+        raw = raw.replace(b'\r\n', b'\n')
+        if raw.endswith(b'\r'):
+            raw = raw[:-1]
+    if raw.find(b'#') != -1 and (raw.startswith(b'#') or b'\n#' in raw):
+        raw = b'\n'.join(line for line in raw.split(b'\n')
+                         if not line.startswith(b'#'))
+    raw = raw.lstrip(b'\n')
+
+    if not raw or raw.isspace():
+        return {name: np.empty(0, dtype=object if dtype is str else
+                               np.float64 if dtype is float else np.int64)
+                for _, name, dtype in columns}
+
+    ncol = raw[:raw.find(b'\n')].count(b'\t') + 1
+
+    # left padding keeps the digit windows of the first record in bounds
+    pad = MAX_DIGITS
+    buf = np.frombuffer(b' ' * pad + raw + (b'' if raw.endswith(b'\n') else b'\n'),
+                        dtype=np.uint8)
+    ends = np.flatnonzero(buf <= 10)  # tab (9) and newline (10)
+
+    if len(ends) % ncol != 0 or (buf[ends[ncol - 1::ncol]] != 10).any():
+        counts = np.array([line.count(b'\t') for line in raw.split(b'\n')])
+        raise ValueError(f"Records must have {ncol} fields each: "
+                         f"{bed_record(raw, np.argmax(counts != ncol - 1))!r}")
+
+    numrec = len(ends) // ncol
+    power = 10.0 ** np.arange(MAX_DIGITS + 1)
+
+    arrays = {}
+    for col, name, dtype in columns:
+        field_end = ends[col::ncol]
+        if col == 0:
+            field_start = np.empty_like(field_end)
+            field_start[0] = pad
+            field_start[1:] = ends[ncol - 1:-1:ncol] + 1
+        else:
+            field_start = ends[col - 1::ncol] + 1
+        width = field_end - field_start
+
+        if dtype is str:
+            # records of a region query mostly share the same value
+            first = buf[field_start[0]:field_end[0]]
+            window = as_strided(buf, shape=(len(buf) - len(first) + 1, len(first)),
+                                strides=(1, 1))
+            if (width == len(first)).all() and (window[field_start] == first).all():
+                arrays[name] = np.full(numrec, first.tobytes().decode(), dtype=object)
+            else:
+                arrays[name] = np.array(
+                    [field.decode() for field in raw.split()[col::ncol]],
+                    dtype=object)
+            continue
+
+        if dtype is float:
+            arrays[name] = np.array(raw.split()[col::ncol]).astype(np.float64)
+            continue
+
+        minwidth = int(width.min())
+        maxwidth = int(width.max())
+        if maxwidth > MAX_DIGITS or minwidth < 1:
+            bad = (width > MAX_DIGITS) | (width < 1)
+            raise ValueError(f"Invalid integer field in column {col + 1}: "
+                             f"{bed_record(raw, np.argmax(bad))!r}")
+
+        # right-aligned windows of maxwidth bytes ending at each field; bytes
+        # left of a (narrower) field belong to the previous field and are
+        # masked before validation and reduction
+        window = as_strided(buf, shape=(len(buf) - maxwidth + 1, maxwidth),
+                            strides=(1, 1))
+        digits = window[field_end - maxwidth] - np.uint8(48)
+        if minwidth < maxwidth:
+            inside = np.arange(maxwidth) >= (maxwidth - width)[:, np.newaxis]
+            digits = np.where(inside, digits, np.uint8(0))
+        bad = (digits > 9).any(axis=1)
+        if bad.any():
+            raise ValueError(f"Invalid integer field in column {col + 1}: "
+                             f"{bed_record(raw, np.argmax(bad))!r}")
+
+        value = digits.astype(np.float64) @ power[maxwidth - 1::-1]
+        arrays[name] = value.astype(np.int64)
+
+    return arrays
+
+
+def read_bed(raw: bytes, columns: List[Tuple]) -> dict:
+    """Parse records with parse_bed, or pd.read_table if parse_bed rejects them.
+
+    parse_bed only accepts plain digits in integer fields; input that
+    pd.read_table also accepts, e.g. fields with leading spaces, is parsed
+    by the latter instead of being dropped.
+
+    Args:
+        raw: Raw bytes of the records, see parse_bed
+        columns: List of (column, name, dtype) tuples as for parse_bed
+
+    Returns:
+        Dictionary of name to array in the order of columns
+
+    Raises:
+        ValueError: If neither parser accepts the records
+    """
+    try:
+        return parse_bed(raw, columns)
+    except ValueError as e:
+        logger.warning(f"Falling back to pd.read_table: {e}")
+
+    dtypes = {str: str, float: np.float64}
+    df = pd.read_table(io.BytesIO(raw), header=None, comment='#',
+                       usecols=[col for col, _, _ in columns],
+                       dtype={col: dtypes.get(dtype, np.int64)
+                              for col, _, dtype in columns})
+    return {name: df[col].to_numpy(dtype=object if dtype is str else None)
+            for col, name, dtype in columns}
+
+
+def parse_kind(dtype: Any) -> type:
+    """Return the parse_bed column type (str, float or int) of a dtype."""
+    if dtype is str:
+        return str
+    if not isinstance(dtype, str) and np.issubdtype(dtype, np.floating):
+        return float
+    return int
+
+
+def bed_frame(arrays: dict, columns: List[Tuple], index_col: List[int]) -> pd.DataFrame:
+    """Return data frame of records parsed by parse_bed.
+
+    Args:
+        arrays: Dictionary of name to array as returned by parse_bed
+        columns: List of (column, name, dtype) tuples with 0-based column
+            numbers; pandas dtypes such as 'UInt32' are applied to the result
+        index_col: Column numbers of the index
+
+    Returns:
+        DataFrame indexed by the index columns
+    """
+    index = [name for col, name, _ in columns if col in index_col]
+    codes = []
+    levels = []
+    for name in index:
+        code, level = (pd.factorize(arrays[name]) if arrays[name].dtype == object
+                       else np.unique(arrays[name], return_inverse=True)[::-1])
+        codes.append(code)
+        levels.append(level)
+
+    data = {name: (pd.array(arrays[name], dtype=dtype) if isinstance(dtype, str)
+                   else arrays[name].astype(dtype, copy=False))
+            for col, name, dtype in columns if col not in index_col}
+    dtypes = {name: dtype for col, name, dtype in columns if col in index_col}
+
+    frame = pd.DataFrame(
+        data,
+        index=pd.MultiIndex(
+            levels=[pd.Index(level, dtype=object if dtypes[name] is str else dtypes[name])
+                    for name, level in zip(index, levels)],
+            codes=codes, names=index, verify_integrity=False))
+
+    return frame
+
+class SiteArray(NamedTuple):
+    """Sites of a region merged across files by get_data(engine='sorted').
+
+    Attributes:
+        chrom: Chromosome of each site
+        start: Start position of each site
+        end: End position of each site
+        counts: Data of shape (sites, sampling units, features); zero where
+            a unit is unobserved
+        valid: Boolean mask of shape (sites, sampling units) of observed units
+        units: Labels of the sampling units
+        features: Names of the features
+    """
+    chrom: np.ndarray
+    start: np.ndarray
+    end: np.ndarray
+    counts: np.ndarray
+    valid: np.ndarray
+    units: List[str]
+    features: List[str]
+
+    @property
+    def empty(self) -> bool:
+        return len(self.start) == 0
+
+    def site_index(self, mask: Optional[np.ndarray] = None) -> pd.MultiIndex:
+        """Return the (#chrom, start, end) index of all or the masked sites."""
+        arrays = [self.chrom, self.start, self.end]
+        if mask is not None:
+            arrays = [array[mask] for array in arrays]
+        return pd.MultiIndex.from_arrays(arrays, names=['#chrom', 'start', 'end'])
+
+
+def site_ranks(chrom: np.ndarray, chroms: List[str]) -> np.ndarray:
+    """Return the rank of the chromosome of each site in chroms.
+
+    Chromosomes missing from chroms are appended to it, so that the ranks
+    of all files of a region stay consistent and sort after the queried
+    chromosomes.
+
+    Args:
+        chrom: Chromosome of each site
+        chroms: Chromosomes in the order they were queried; extended in place
+
+    Returns:
+        Array of ranks
+    """
+    if len(chroms) == 1 and (chrom == chroms[0]).all():
+        return np.zeros(len(chrom), dtype=np.int64)
+
+    rank = pd.Categorical(chrom, categories=chroms).codes.astype(np.int64)
+    if (rank < 0).any():
+        chroms.extend(pd.unique(chrom[rank < 0]))
+        rank = pd.Categorical(chrom, categories=chroms).codes.astype(np.int64)
+
+    return rank
+
+
+def read_sites(arrays: dict, chroms: List[str],
+               min_coverage: Optional[int] = None) -> Tuple[np.ndarray, ...]:
+    """Return the coordinates and data values of parsed bed records.
+
+    Args:
+        arrays: Dictionary of name to array as returned by parse_bed for the
+            index columns followed by the data columns
+        chroms: Chromosomes in the order they were queried, see site_ranks
+        min_coverage: Drop records whose data columns sum to less than this
+            value (optional)
+
+    Returns:
+        Tuple of chromosome ranks, starts, ends and data values of shape
+        (sites, features)
+    """
+    chrom, start, end, *data = arrays.values()
+
+    rank = site_ranks(chrom, chroms)
+    values = np.column_stack(data) if data else np.empty((len(rank), 0))
+
+    if min_coverage is not None:
+        keep = values.sum(axis=1) >= min_coverage
+        return rank[keep], start[keep], end[keep], values[keep]
+
+    return rank, start, end, values
+
+
+def merge_sites(sites: List[Optional[Tuple[np.ndarray, ...]]],
+                units: List[str], features: List[str], chroms: List[str],
+                min_samplesize: Optional[int] = None,
+                compact: bool = False) -> SiteArray:
+    """Merge the sites of several files into a SiteArray.
+
+    The sites of all files are ordered by (chromosome rank, start, end) with
+    np.lexsort; consecutive equal coordinates form one site of the union.
+    The data of each file is then scattered into a preallocated (sites,
+    units, features) array at the union positions of its records.
+    Coordinates are compared in full, so sites are never merged or dropped
+    because of their size.
+
+    Args:
+        sites: List of (rank, start, end, values) as returned by read_sites,
+            or None for files that could not be read
+        units: Labels of the files
+        features: Names of the data columns
+        chroms: Chromosomes of the ranks, see site_ranks
+        min_samplesize: Drop sites observed in fewer than this number of
+            files (optional)
+        compact: Store counts as uint32 and positions as int32 instead of
+            float64 and int64 (default: False)
+
+    Returns:
+        SiteArray of the merged sites
+    """
+    present = [i for i, site in enumerate(sites) if site is not None]
+    if present:
+        rank, start, end = (np.concatenate([sites[i][field] for i in present])
+                            for field in range(3))
+    else:
+        rank = start = end = np.empty(0, dtype=np.int64)
+
+    order = np.lexsort((end, start, rank))
+    rank, start, end = rank[order], start[order], end[order]
+    new = np.ones(len(order), dtype=bool)
+    new[1:] = ((rank[1:] != rank[:-1]) | (start[1:] != start[:-1]) |
+               (end[1:] != end[:-1]))
+    # union position of each record in the order of the files
+    position = np.empty(len(order), dtype=np.int64)
+    position[order] = np.cumsum(new) - 1
+    rank, start, end = rank[new], start[new], end[new]
+
+    counts = np.zeros((len(rank), len(units), len(features)),
+                      dtype=np.uint32 if compact else np.float64)
+    valid = np.zeros((len(rank), len(units)), dtype=bool)
+    offset = 0
+    for i in present:
+        values = sites[i][3]
+        pos = position[offset:offset + len(values)]
+        counts[pos, i] = values
+        valid[pos, i] = True
+        offset += len(values)
+
+    if min_samplesize is not None and min_samplesize > 1:
+        keep = valid.sum(axis=1) >= min_samplesize
+        rank, start, end = rank[keep], start[keep], end[keep]
+        counts = counts[keep]
+        valid = valid[keep]
+
+    position_dtype = np.int32 if compact else np.int64
+    chrom = np.array(chroms, dtype=object)[rank]
+
+    return SiteArray(chrom, start.astype(position_dtype),
+                     end.astype(position_dtype), counts, valid,
+                     list(units), list(features))
+
+
+class RegionCache:
+    """In-process LRU cache of records parsed by parse_bed.
+
+    Entries are keyed by file, modification time and tabix query, so that
+    a modified file is read again. Each entry holds the parsed columns of
+    one file and region; requests for any subset of these columns are hits,
+    e.g. when only some samples or data columns of a cohort are queried
+    again. The least recently used entries are evicted once the arrays
+    exceed maxbytes.
+
+    Example:
+        >>> cache = RegionCache(maxbytes=2**30)
+        >>> data = list(get_data(files, ..., cache=cache))
+        >>> cache.stats()
+    """
+
+    def __init__(self, maxbytes: int = 2**28):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(file_: str, query: List[str]) -> Optional[Tuple]:
+        """Return the cache key of a query, or None for remote files.
+
+        The key includes the modification times of the file and of its
+        .tbi index, so that entries of rewritten or reindexed files are
+        not used.
+        """
+        try:
+            mtime = os.stat(file_).st_mtime_ns
+        except OSError:
+            return None
+        try:
+            index_mtime = os.stat(file_ + '.tbi').st_mtime_ns
+        except OSError:
+            index_mtime = None
+        return (file_, mtime, index_mtime, tuple(query))
+
+    def get(self, key: Optional[Tuple], columns: List[Tuple]) -> Optional[dict]:
+        """Return the cached arrays of columns, or None on a miss.
+
+        Args:
+            key: Cache key as returned by key
+            columns: List of (column, name, kind) tuples as for parse_bed
+
+        Returns:
+            Dictionary of name to array in the order of columns or None
+        """
+        entry = self._entries.get(key) if key is not None else None
+        if entry is None or any((col, kind) not in entry for col, _, kind in columns):
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return {name: entry[(col, kind)] for col, name, kind in columns}
+
+    def put(self, key: Optional[Tuple], columns: List[Tuple], arrays: dict) -> None:
+        """Store arrays parsed for columns, adding to an existing entry.
+
+        The arrays are made read-only as they are shared with later hits.
+        """
+        if key is None:
+            return
+
+        entry = self._entries.pop(key, {})
+        self.nbytes -= sum(array.nbytes for array in entry.values())
+        for col, name, kind in columns:
+            arrays[name].flags.writeable = False
+            entry[(col, kind)] = arrays[name]
+        size = sum(array.nbytes for array in entry.values())
+        if size > self.maxbytes:
+            return
+
+        self._entries[key] = entry
+        self.nbytes += size
+        while self.nbytes > self.maxbytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= sum(array.nbytes for array in evicted.values())
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """Remove all entries; the statistics are kept."""
+        self._entries.clear()
+        self.nbytes = 0
+
+    def stats(self) -> dict:
+        """Return hits, misses, hit rate, evictions, entries and bytes."""
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit rate': self.hits / requests if requests else 0.0,
+                'evictions': self.evictions, 'entries': len(self._entries),
+                'bytes': self.nbytes, 'maxbytes': self.maxbytes}
+
+
+def get_data(files: List[str], labels: Optional[List[str]] = None,
              data_columns: Optional[List[List[Tuple]]] = None, 
              regions: Optional[List[Tuple]] = None, join: str = 'outer',
-             preset: str = 'bed') -> Generator[pd.DataFrame, None, None]:
+             preset: str = 'bed', min_coverage: Optional[int] = None,
+             min_samplesize: Optional[int] = None,
+             compact: bool = False,
+             engine: str = 'concat',
+             cache: Optional[RegionCache] = None) -> Generator[Union[pd.DataFrame, SiteArray], None, None]:
     """Combines tabix-indexed genome position files.
     
     Args:
         files: List of file paths
         labels: List of labels for files (optional)
         data_columns: List of data columns specifications (optional)
-        regions: List of regions to process (optional)
+        regions: List of regions to process (optional); a region is a
+            (chrom, start, end) tuple or a list of such tuples that are
+            queried together
         join: Type of join operation (default: 'outer')
-        preset: File format preset (default: 'bed')
+        preset: File format preset (default: 'bed'); bed records are read
+            with the fixed-schema parser parse_bed, falling back to
+            pd.read_table for records it rejects (see read_bed)
+        min_coverage: Drop records of a file whose data columns sum to less
+            than this value, i.e. treat the site as unobserved in that
+            sampling unit (optional)
+        min_samplesize: Drop sites observed in fewer than this number of
+            files before merging (optional)
+        compact: Read positions as int32 and integer data as nullable
+            unsigned integers (UInt16 where the values fit, else UInt32),
+            so that missing values are masked rather than promoting the
+            merged frame to float64 (default: False)
+        engine: How the files are merged; 'concat' aligns one data frame
+            per file with pd.concat, 'sorted' merges the coordinate-sorted
+            sites of the bed records into a SiteArray (see merge_sites)
+            without building data frames (default: 'concat')
+        cache: Cache of the parsed records of each file and region; files
+            found in the cache are not read again (optional, bed preset
+            only)
         
     Yields:
-        DataFrame: Combined data for each region
+        DataFrame or SiteArray: Combined data for each region
         
     Raises:
         InputMismatchError: If input parameters don't match
@@ -147,10 +682,11 @@ def get_data(files: List[str], labels: Optional[List[str]] = None,
 
         # Configure preset-specific settings
         if preset == 'bed':
+            position_dtype = np.int32 if compact else np.int64
             index = [
                 (0, '#chrom', str),
-                (1, 'start', np.int64),
-                (2, 'end', np.int64)]
+                (1, 'start', position_dtype),
+                (2, 'end', position_dtype)]
             index_col = [i[0] for i in index]
         elif preset == 'gff':
             # TODO: Implement GFF support
@@ -167,9 +703,27 @@ def get_data(files: List[str], labels: Optional[List[str]] = None,
         else:
             raise ValueError(f"Unsupported preset: {preset}")
 
+        if engine not in ('concat', 'sorted'):
+            raise ValueError(f"Unsupported engine: {engine}")
+        if engine == 'sorted':
+            features = [name for _, name, _ in data_columns[0]]
+            if any([name for _, name, _ in cols] != features for cols in data_columns):
+                raise InputMismatchError(
+                    'The sorted engine requires the same data column names '
+                    'for all files!')
+
         # Output columns
         names = ['sampling_unit', 'feature']
+        if compact:
+            compact_dtype = {int: 'UInt32', float: np.float32}
+            data_columns = [[(col, name, compact_dtype.get(dtype, dtype))
+                             for col, name, dtype in cols]
+                            for cols in data_columns]
         columns = [index + cols for cols in data_columns]
+        parse_columns = [[(col, name, parse_kind(dtype)) for col, name, dtype in cols]
+                         for cols in columns]
+        if preset != 'bed':
+            cache = None
 
         if regions is None:
             logger.warning("No regions provided")
@@ -177,18 +731,31 @@ def get_data(files: List[str], labels: Optional[List[str]] = None,
 
         for region in regions:
             try:
-                query = '{0}:{1}-{2}'.format(*region)
-                logger.debug(f"Processing region: {query}")
+                if isinstance(region, list):
+                    query = ['{0}:{1}-{2}'.format(*r) for r in region]
+                    chroms = list(dict.fromkeys(r[0] for r in region))
+                else:
+                    query = ['{0}:{1}-{2}'.format(*region)]
+                    chroms = [region[0]]
+                logger.debug(f"Processing region: {' '.join(query)}")
+
+                # Look up cached records
+                cache_keys = [cache.key(file_, query) if cache is not None else None
+                              for file_ in files]
+                cached = [cache.get(key, parse_columns[i]) if cache is not None else None
+                          for i, key in enumerate(cache_keys)]
 
                 # Create tabix processes
                 tabix_processes = []
-                for file_ in files:
+                for file_, arrays in zip(files, cached):
+                    if arrays is not None:
+                        tabix_processes.append(None)
+                        continue
                     try:
                         process = subprocess.Popen(
-                            ['tabix', file_, query],
+                            ['tabix', file_] + query,
                             stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            universal_newlines=True
+                            stderr=subprocess.PIPE
                         )
                         tabix_processes.append(process)
                     except FileNotFoundError:
@@ -199,29 +766,74 @@ def get_data(files: List[str], labels: Optional[List[str]] = None,
 
                 # Create dataframes
                 dframes = []
+                sites = []
                 for i, tbx in tabix:
                     try:
-                        df = pd.read_table(
-                            tbx.stdout,
-                            header=None,
-                            index_col=index_col,
-                            comment='#',
-                            usecols=[f[0] for f in columns[i]],
-                            names=[f[1] for f in columns[i]],
-                            dtype={f[1]: f[2] for f in columns[i]}
-                        )
-                        dframes.append(df)
+                        if preset == 'bed':
+                            arrays = cached[i]
+                            if arrays is None:
+                                arrays = read_bed(tbx.stdout.read(), parse_columns[i])
+
+                        if engine == 'sorted':
+                            sites.append(read_sites(
+                                arrays, chroms, min_coverage=min_coverage))
+                        elif preset == 'bed':
+                            df = bed_frame(arrays, columns[i], index_col)
+                        else:
+                            df = pd.read_table(
+                                tbx.stdout,
+                                header=None,
+                                index_col=index_col,
+                                comment='#',
+                                usecols=[f[0] for f in columns[i]],
+                                names=[f[1] for f in columns[i]],
+                                dtype={f[1]: f[2] for f in columns[i]}
+                            )
+                        if engine == 'concat':
+                            if min_coverage is not None:
+                                df = df[df.sum(axis=1) >= min_coverage]
+                            if compact:
+                                narrow = [name for name, dtype in df.dtypes.items()
+                                          if dtype == 'UInt32' and
+                                          not (df[name].max() >= 2**16)]
+                                df = df.astype({name: 'UInt16' for name in narrow})
+                            dframes.append(df)
                         
                         # Wait for process to complete and check for errors
-                        return_code = tbx.wait()
+                        return_code = tbx.wait() if tbx is not None else 0
                         if return_code != 0:
-                            stderr_output = tbx.stderr.read()
+                            stderr_output = tbx.stderr.read().decode()
                             logger.warning(f"tabix process returned code {return_code}: {stderr_output}")
+                        elif tbx is not None and cache is not None:
+                            # only cache complete output of tabix
+                            cache.put(cache_keys[i], parse_columns[i], arrays)
                             
                     except Exception as e:
                         logger.error(f"Error reading data from tabix process: {e}")
                         # Continue with empty dataframe
-                        dframes.append(pd.DataFrame())
+                        if engine == 'sorted':
+                            sites.append(None)
+                        else:
+                            dframes.append(pd.DataFrame())
+
+                if engine == 'sorted':
+                    merged_sites = merge_sites(
+                        sites, keys, features, chroms,
+                        min_samplesize=min_samplesize, compact=compact)
+                    logger.debug(f"Merged sites shape: {merged_sites.counts.shape}")
+                    yield merged_sites
+                    continue
+
+                # Drop sites below the minimum sample size before merging
+                if dframes and min_samplesize is not None and min_samplesize > 1:
+                    observed = [df.index for df in dframes if not df.empty]
+                    if observed:
+                        seen = observed[0].append(observed[1:]).value_counts()
+                        keep = seen.index[seen >= min_samplesize]
+                    else:
+                        keep = []
+                    dframes = [df[df.index.isin(keep)] if not df.empty else df
+                               for df in dframes]
 
                 # Merge dataframes
                 if dframes:
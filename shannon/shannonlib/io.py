@@ -62,13 +62,15 @@ def bedcount_reader(bedcount: str, compression: Optional[str] = None,
 
 
 def population_filter(metadata: str, subset: Optional[str] = None, 
-                     relation: Optional[str] = None) -> Dict[str, Any]:
+                     relation: Optional[Union[str, List[str]]] = None) -> Dict[str, Any]:
     """Read metadata and return the population and the quotient set.
     
     Args:
         metadata: Path to metadata file
         subset: Query string for subsetting (optional)
-        relation: Column name for grouping (optional)
+        relation: Column name(s) for grouping; several columns give the
+            groups of their level combinations, e.g. tissue within ecotype
+            (optional)
         
     Returns:
         Dictionary with 'reference' and 'qset' keys
@@ -112,12 +114,14 @@ def population_filter(metadata: str, subset: Optional[str] = None,
         if relation is not None:
             logger.debug(f"Applying relation grouping by: {relation}")
             
-            if relation not in meta.columns:
-                raise ValueError(f"Relation column '{relation}' not found in metadata")
+            factors = [relation] if isinstance(relation, str) else list(relation)
+            for factor in factors:
+                if factor not in meta.columns:
+                    raise ValueError(f"Relation column '{factor}' not found in metadata")
             
             try:
                 reference_meta = meta[meta['sample'].isin(pop['reference'])]
-                group = reference_meta.groupby([relation])
+                group = reference_meta.groupby(factors)
                 qset = []
                 
                 for name, df in group:
@@ -141,3 +145,63 @@ def population_filter(metadata: str, subset: Optional[str] = None,
     except Exception as e:
         logger.error(f"Error in population filter: {e}")
         raise RuntimeError(f"Population filtering failed: {e}")
+
+
+def target_reader(bedfile: str, chrom: Optional[str] = None) -> pd.DataFrame:
+    """Read target intervals from a BED file and merge overlapping ones.
+
+    Args:
+        bedfile: Path to BED file (first three columns are used)
+        chrom: Restrict targets to this chromosome (optional)
+
+    Returns:
+        DataFrame with '#chrom', 'start' and 'end' columns (0-based,
+        half-open) of non-overlapping intervals sorted by coordinate
+
+    Raises:
+        FileNotFoundError: If BED file doesn't exist
+        ValueError: If BED file path is empty
+        RuntimeError: If reading or merging fails
+    """
+    logger.debug(f"Reading target intervals from BED file: {bedfile}")
+
+    if not bedfile:
+        raise ValueError("BED file path cannot be empty")
+
+    try:
+        targets = pd.read_table(
+            bedfile,
+            header=None,
+            comment='#',
+            usecols=[0, 1, 2],
+            names=['#chrom', 'start', 'end'],
+            dtype={'#chrom': str, 'start': np.int64, 'end': np.int64}
+        )
+
+        if chrom is not None:
+            targets = targets[targets['#chrom'] == chrom]
+
+        if targets.empty:
+            logger.warning("No target intervals found")
+            return targets.reset_index(drop=True)
+
+        # merge overlapping and book-ended intervals per chromosome
+        targets = targets.sort_values(['#chrom', 'start', 'end'])
+        reach = (targets
+                 .groupby('#chrom')['end'].cummax()
+                 .groupby(targets['#chrom']).shift())
+        cluster = (~(targets['start'] <= reach)).cumsum()
+        merged = (targets
+                  .groupby(cluster)
+                  .agg({'#chrom': 'first', 'start': 'min', 'end': 'max'})
+                  .reset_index(drop=True))
+
+        logger.debug(f"Merged {len(targets)} targets into {len(merged)} intervals")
+        return merged
+
+    except FileNotFoundError:
+        logger.error(f"BED file not found: {bedfile}")
+        raise
+    except Exception as e:
+        logger.error(f"Error reading target intervals: {e}")
+        raise RuntimeError(f"Failed to read target intervals: {e}")
@@ -0,0 +1,340 @@
+# -*- coding:utf-8 -*-
+# serve.py
+
+"""Long-lived query server.
+
+This module keeps a cohort loaded and answers JS divergence queries over
+small windows via HTTP, either on a TCP port or on a Unix socket, e.g.
+
+    curl --unix-socket shannon.sock 'http://localhost/query?region=1:1000-2000'
+
+Tabix handles are kept open if pysam is installed; otherwise each query
+runs the tabix command. In both cases parsed records are kept in a
+gpf.RegionCache, so repeated windows are not read again.
+"""
+
+import io
+import json
+import logging
+import os
+import re
+import socketserver
+import stat
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+import shannonlib.estimators as est
+import shannonlib.gpf_utils as gpf
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+logger = logging.getLogger(__name__)
+
+
+REGION = re.compile(r'^(?P<chrom>[^:\s-][^:\s]*):(?P<start>\d+)-(?P<end>\d+)$')
+
+
+class QueryError(Exception):
+    """Raised when a query cannot be answered from the cohort."""
+    pass
+
+
+def parse_region(region: str) -> tuple:
+    """Return (chrom, start, end) of a 1-based, closed tabix region string.
+
+    Raises:
+        QueryError: If the region is malformed
+    """
+    match = REGION.match(region)
+    if match is None or int(match['start']) > int(match['end']):
+        raise QueryError(f"Invalid region: {region} (expected chrom:start-end)")
+    return match['chrom'], int(match['start']), int(match['end'])
+
+
+class Cohort:
+    """Samples of a cohort with open tabix handles and a region cache.
+
+    Args:
+        sample: DataFrame of metadata with 'url' and 'label' columns; other
+            columns can be used to select groups in queries
+        data_columns: List of (column, name, dtype) tuples of the data
+            columns, with 0-based column numbers
+        min_count: See est.js_divergence (default: 3)
+        min_samplesize: See est.js_divergence (default: 2)
+        min_coverage: See gpf.get_data (optional)
+        weights: See est.js_divergence (default: None)
+        cache_bytes: Size limit of the region cache (default: 2**28)
+    """
+
+    def __init__(self, sample: pd.DataFrame, data_columns: List[tuple],
+                 min_count: int = 3, min_samplesize: int = 2,
+                 min_coverage: Optional[int] = None, weights: Optional[str] = None,
+                 cache_bytes: int = 2**28):
+        self.sample = sample.reset_index(drop=True)
+        self.labels = list(self.sample['label'])
+        self.urls = list(self.sample['url'])
+        self.features = [name for _, name, _ in data_columns]
+        self.columns = [(0, '#chrom', str), (1, 'start', int), (2, 'end', int)] + \
+            [(col, name, gpf.parse_kind(dtype)) for col, name, dtype in data_columns]
+        self.min_count = min_count
+        self.min_samplesize = min_samplesize
+        self.min_coverage = min_coverage
+        self.weights = weights
+        self.cache = gpf.RegionCache(maxbytes=cache_bytes)
+        self.queries = 0
+        self.started = time.time()
+        # handles are not safe for concurrent use
+        self._lock = threading.Lock()
+
+        if pysam is not None:
+            self.handles = [pysam.TabixFile(url) for url in self.urls]
+            logger.info(f"Opened {len(self.handles)} tabix handles")
+        else:
+            self.handles = None
+            logger.info("pysam not available, querying with the tabix command")
+
+    def fetch(self, position: int, query: List[str]) -> bytes:
+        """Return the raw records of a sample in the queried regions."""
+        if self.handles is not None:
+            lines = [line for region in query
+                     for line in self.handles[position].fetch(region=region)]
+            return ('\n'.join(lines) + '\n').encode() if lines else b''
+
+        result = subprocess.run(['tabix', self.urls[position]] + query,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise QueryError(f"tabix failed for {self.urls[position]}: "
+                             f"{result.stderr.decode().strip()}")
+        return result.stdout
+
+    def units(self, group: Optional[str] = None) -> List[int]:
+        """Return the positions of the samples in a group 'factor=level'.
+
+        Raises:
+            QueryError: If the factor or level does not exist
+        """
+        if group is None:
+            return list(range(len(self.labels)))
+
+        factor, _, level = group.partition('=')
+        if factor not in self.sample.columns or factor in ('url', 'label'):
+            raise QueryError(f"Unknown group factor: {factor}")
+        position = list(np.flatnonzero(self.sample[factor].astype(str) == level))
+        if not position:
+            raise QueryError(f"No samples in group: {group}")
+        return position
+
+    def query(self, regions: List[str], group: Optional[str] = None,
+              metrics: Optional[List[str]] = None) -> pd.DataFrame:
+        """JS divergence of the samples of a group in regions.
+
+        Args:
+            regions: List of 1-based, closed regions 'chrom:start-end'
+            group: Group 'factor=level' of metadata (default: all samples)
+            metrics: Metrics, see est.js_divergence (default: JSD and HMIX)
+
+        Returns:
+            DataFrame as returned by est.js_divergence
+
+        Raises:
+            QueryError: If the query is invalid
+        """
+        chroms = list(dict.fromkeys(parse_region(region)[0] for region in regions))
+        position = self.units(group)
+
+        sites = []
+        with self._lock:
+            for i in position:
+                key = self.cache.key(self.urls[i], regions)
+                arrays = self.cache.get(key, self.columns)
+                if arrays is None:
+                    try:
+                        arrays = gpf.read_bed(self.fetch(i, regions), self.columns)
+                    except QueryError:
+                        raise
+                    except Exception as e:
+                        # e.g. contigs missing from the index of a file
+                        raise QueryError(f"Cannot read {self.urls[i]}: {e}")
+                    self.cache.put(key, self.columns, arrays)
+                sites.append(gpf.read_sites(arrays, chroms,
+                                            min_coverage=self.min_coverage))
+            self.queries += 1
+
+        data = gpf.merge_sites(sites, [self.labels[i] for i in position],
+                               self.features, chroms,
+                               min_samplesize=self.min_samplesize)
+        try:
+            div = est.js_divergence(data, weights=self.weights,
+                                    min_count=self.min_count,
+                                    min_samplesize=self.min_samplesize,
+                                    metrics=metrics)
+            if div.empty:
+                div = self.no_sites(data.units, metrics)
+        except ValueError as e:
+            raise QueryError(str(e))
+        return div
+
+    def no_sites(self, units: List[str], metrics: Optional[List[str]] = None) -> pd.DataFrame:
+        """Return a result without rows with the index and columns of a query.
+
+        est.js_divergence returns a DataFrame without columns if no site
+        passes QC; the columns are taken from the result of a single site
+        observed in all units instead.
+        """
+        site = gpf.SiteArray(
+            np.array(['.'], dtype=object), np.zeros(1, dtype=np.int64),
+            np.zeros(1, dtype=np.int64),
+            np.full((1, len(units), len(self.features)), max(self.min_count, 1),
+                    dtype=np.float64),
+            np.ones((1, len(units)), dtype=bool), list(units), self.features)
+        div = est.js_divergence(site, weights=self.weights, min_count=self.min_count,
+                                min_samplesize=1, metrics=metrics)
+        return div.iloc[:0]
+
+    def status(self) -> Dict:
+        """Return the cohort size, number of queries and cache statistics."""
+        return {'samples': len(self.labels), 'features': self.features,
+                'pysam': self.handles is not None, 'queries': self.queries,
+                'uptime': round(time.time() - self.started, 1),
+                'cache': self.cache.stats()}
+
+
+def to_json(div: pd.DataFrame) -> bytes:
+    """Encode results as JSON with 'columns' and row-wise 'data'."""
+    return div.reset_index().to_json(orient='split', index=False).encode()
+
+
+def to_npy(div: pd.DataFrame) -> bytes:
+    """Encode results as a structured numpy array in .npy format."""
+    table = div.reset_index()
+    # fixed-width strings, as object arrays cannot be saved without pickle
+    records = table.to_records(index=False, column_dtypes={
+        column: np.asarray(table[column], dtype=str).dtype
+        for column in table.columns if table[column].dtype == object})
+    buffer = io.BytesIO()
+    np.save(buffer, records, allow_pickle=False)
+    return buffer.getvalue()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Answers GET /query and GET /status of the server's cohort.
+
+    Query parameters of /query:
+
+    - region: 'chrom:start-end' (1-based, closed); repeat for several
+    - group: 'factor=level' of metadata (default: all samples)
+    - metrics: comma-separated metrics (default: JSD,HMIX)
+    - format: 'json' or 'npy' (default: json)
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        cohort = self.server.cohort
+
+        try:
+            if url.path == '/status':
+                self.reply(200, json.dumps(cohort.status()).encode())
+                return
+            if url.path != '/query':
+                self.reply(404, json.dumps({'error': f"Unknown path: {url.path}"}).encode())
+                return
+
+            if 'region' not in params:
+                raise QueryError("Missing parameter: region")
+            form = params.get('format', ['json'])[0]
+            if form not in ('json', 'npy'):
+                raise QueryError(f"Unsupported format: {form}")
+            metrics = params['metrics'][0].split(',') if 'metrics' in params else None
+
+            div = cohort.query(params['region'], group=params.get('group', [None])[0],
+                               metrics=metrics)
+            if form == 'npy':
+                self.reply(200, to_npy(div), 'application/octet-stream')
+            else:
+                self.reply(200, to_json(div))
+
+        except QueryError as e:
+            self.reply(400, json.dumps({'error': str(e)}).encode())
+        except Exception as e:
+            logger.error(f"Query {self.path} failed: {e}")
+            self.reply(500, json.dumps({'error': str(e)}).encode())
+
+    def reply(self, code: int, body: bytes, content_type: str = 'application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # clients of Unix sockets have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    """HTTP server listening on a Unix socket."""
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ('unix', 0)
+
+
+def serve(sample: pd.DataFrame, data_columns: List[tuple],
+          socket_path: Optional[str] = None, host: str = '127.0.0.1',
+          port: int = 8765, **kwargs) -> None:
+    """Load a cohort and answer queries until interrupted.
+
+    Args:
+        sample: DataFrame of metadata, see Cohort
+        data_columns: List of (column, name, dtype) tuples, see Cohort
+        socket_path: Unix socket to listen on; if None, listen on host and
+            port (optional)
+        host: Host to listen on (default: '127.0.0.1')
+        port: Port to listen on (default: 8765)
+        **kwargs: Further arguments of Cohort
+
+    Raises:
+        OSError: If the socket cannot be bound or socket_path exists and
+            is not a socket
+    """
+    # debug logging of every block would dominate the query latency
+    logging.getLogger('shannonlib').setLevel(logging.INFO)
+
+    cohort = Cohort(sample, data_columns, **kwargs)
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            # remove the socket of a previous run, but no other file
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise OSError(f"Not a socket: {socket_path}")
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, QueryHandler)
+        address = socket_path
+    else:
+        server = HTTPServer((host, port), QueryHandler)
+        address = f'http://{host}:{port}'
+    server.cohort = cohort
+
+    logger.info(f"Serving {len(cohort.labels)} samples on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Server stopped")
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,431 @@
+# -*- coding:utf-8 -*-
+# summary.py
+
+"""Streaming summary statistics of per-site results.
+
+This module provides accumulators that summarise the distribution of
+per-site metrics (JSD, HMIX, ...) region by region without keeping the
+sites: running moments, fixed-bin histograms and t-digest quantile
+sketches. All accumulators can be merged, so that summaries of different
+workers (e.g. one per chromosome) combine into one report.
+"""
+
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+class Moments:
+    """Running count, mean, variance, minimum and maximum."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values: np.ndarray) -> None:
+        """Add a batch of values."""
+        if len(values):
+            batch = Moments()
+            batch.n = len(values)
+            batch.mean = float(values.mean())
+            batch.m2 = float(((values - batch.mean)**2).sum())
+            batch.min = float(values.min())
+            batch.max = float(values.max())
+            self.merge(batch)
+
+    def merge(self, other: 'Moments') -> None:
+        """Add the values summarised by other (Chan et al. update)."""
+        if other.n == 0:
+            return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean += delta * other.n / n
+        self.m2 += other.m2 + delta**2 * self.n * other.n / n
+        self.n = n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def sd(self) -> float:
+        """Sample standard deviation (NaN for fewer than two values)."""
+        return float(np.sqrt(self.m2 / (self.n - 1))) if self.n > 1 else np.nan
+
+    def to_dict(self) -> Dict:
+        return {'n': self.n, 'mean': self.mean, 'm2': self.m2,
+                'min': self.min if self.n else None,
+                'max': self.max if self.n else None}
+
+    @classmethod
+    def from_dict(cls, state: Dict) -> 'Moments':
+        moments = cls()
+        moments.n = state['n']
+        moments.mean = state['mean']
+        moments.m2 = state['m2']
+        if state['n']:
+            moments.min = state['min']
+            moments.max = state['max']
+        return moments
+
+
+class Histogram:
+    """Histogram with fixed, equally spaced bins.
+
+    Values below the lower or above the upper bound are counted separately,
+    so that no value is lost and histograms with equal bins can be merged.
+    """
+
+    def __init__(self, lower: float = 0.0, upper: float = 1.0, bins: int = 100):
+        self.lower = lower
+        self.upper = upper
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+    @property
+    def edges(self) -> np.ndarray:
+        return np.linspace(self.lower, self.upper, len(self.counts) + 1)
+
+    def update(self, values: np.ndarray) -> None:
+        """Add a batch of values; the upper bound falls in the last bin.
+
+        Values within floating-point error of a bound, e.g. a JSD of -1e-16
+        for units with the same profile, are counted in the outer bins.
+        """
+        values = np.where(np.isclose(values, self.lower), self.lower, values)
+        values = np.where(np.isclose(values, self.upper), self.upper, values)
+        below = values < self.lower
+        above = values > self.upper
+        inside = values[~(below | above)]
+        self.underflow += int(below.sum())
+        self.overflow += int(above.sum())
+        bins = len(self.counts)
+        index = ((inside - self.lower) / (self.upper - self.lower) * bins).astype(np.int64)
+        self.counts += np.bincount(np.minimum(index, bins - 1), minlength=bins)
+
+    def merge(self, other: 'Histogram') -> None:
+        """Add the counts of a histogram with the same bins.
+
+        Raises:
+            ValueError: If the bins differ
+        """
+        if (self.lower, self.upper, len(self.counts)) != \
+                (other.lower, other.upper, len(other.counts)):
+            raise ValueError("Histograms with different bins cannot be merged")
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+
+    def to_dict(self) -> Dict:
+        return {'lower': self.lower, 'upper': self.upper,
+                'counts': self.counts.tolist(),
+                'underflow': self.underflow, 'overflow': self.overflow}
+
+    @classmethod
+    def from_dict(cls, state: Dict) -> 'Histogram':
+        histogram = cls(state['lower'], state['upper'], len(state['counts']))
+        histogram.counts = np.asarray(state['counts'], dtype=np.int64)
+        histogram.underflow = state['underflow']
+        histogram.overflow = state['overflow']
+        return histogram
+
+
+class QuantileDigest:
+    """Quantile sketch after the merging t-digest of Dunning & Ertl.
+
+    Values are kept as weighted centroids. On compression, centroids sorted
+    by mean are combined wherever they fall between the same integers of
+    the scale k(q) = compression / (2 pi) * asin(2q - 1), which bounds the
+    number of centroids by about the compression and keeps them small, i.e.
+    accurate, at the tails.
+    """
+
+    def __init__(self, compression: float = 100):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values: np.ndarray) -> None:
+        """Add a batch of values."""
+        if len(values):
+            self.min = min(self.min, float(values.min()))
+            self.max = max(self.max, float(values.max()))
+            self._compress(np.concatenate([self.means, values]),
+                           np.concatenate([self.weights, np.ones(len(values))]))
+
+    def merge(self, other: 'QuantileDigest') -> None:
+        """Add the centroids of other."""
+        if len(other.means):
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self._compress(np.concatenate([self.means, other.means]),
+                           np.concatenate([self.weights, other.weights]))
+
+    def _compress(self, means: np.ndarray, weights: np.ndarray) -> None:
+        order = np.argsort(means, kind='stable')
+        means = means[order]
+        weights = weights[order]
+        total = weights.sum()
+        # quantiles at the left edge and in the middle of each centroid
+        left = (np.cumsum(weights) - weights) / total
+        middle = left + weights / (2 * total)
+        scale = self.compression / (2 * np.pi)
+        k = np.floor(scale * np.arcsin(2 * middle - 1))
+        # singletons at the extremes keep min and max exact
+        k[0] = -np.inf
+        k[-1] = np.inf
+        new = np.flatnonzero(np.concatenate(([True], k[1:] != k[:-1])))
+        merged = np.add.reduceat(weights, new)
+        self.means = np.add.reduceat(means * weights, new) / merged
+        self.weights = merged
+
+    def quantile(self, q: float) -> float:
+        """Estimate the q-quantile (NaN if empty)."""
+        if not len(self.means):
+            return np.nan
+        total = self.weights.sum()
+        centers = (np.cumsum(self.weights) - self.weights / 2) / total
+        return float(np.interp(q, np.concatenate(([0], centers, [1])),
+                               np.concatenate(([self.min], self.means, [self.max]))))
+
+    def to_dict(self) -> Dict:
+        return {'compression': self.compression,
+                'means': self.means.tolist(), 'weights': self.weights.tolist(),
+                'min': self.min if len(self.means) else None,
+                'max': self.max if len(self.means) else None}
+
+    @classmethod
+    def from_dict(cls, state: Dict) -> 'QuantileDigest':
+        digest = cls(state['compression'])
+        digest.means = np.asarray(state['means'], dtype=np.float64)
+        digest.weights = np.asarray(state['weights'], dtype=np.float64)
+        if len(digest.means):
+            digest.min = state['min']
+            digest.max = state['max']
+        return digest
+
+
+class MetricSummary:
+    """Moments, histogram and quantile sketch of one metric."""
+
+    def __init__(self, bins: int = 100, compression: float = 100):
+        self.moments = Moments()
+        self.histogram = Histogram(bins=bins)
+        self.digest = QuantileDigest(compression)
+
+    def update(self, values: np.ndarray) -> None:
+        """Add a batch of values; NaN values are ignored."""
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        self.moments.update(values)
+        self.histogram.update(values)
+        self.digest.update(values)
+
+    def merge(self, other: 'MetricSummary') -> None:
+        self.moments.merge(other.moments)
+        self.histogram.merge(other.histogram)
+        self.digest.merge(other.digest)
+
+    def to_dict(self) -> Dict:
+        return {'moments': self.moments.to_dict(),
+                'histogram': self.histogram.to_dict(),
+                'digest': self.digest.to_dict()}
+
+    @classmethod
+    def from_dict(cls, state: Dict) -> 'MetricSummary':
+        summary = cls()
+        summary.moments = Moments.from_dict(state['moments'])
+        summary.histogram = Histogram.from_dict(state['histogram'])
+        summary.digest = QuantileDigest.from_dict(state['digest'])
+        return summary
+
+
+def is_metric(column: str) -> bool:
+    """Return True for information-theoretic quantities and levels."""
+    return column.endswith('_bit_') or column == 'MET'
+
+
+class Summary:
+    """Summaries of per-site metrics by chromosome, context and group.
+
+    For each (chrom, context, group) key the number of sites read, the
+    number of sites passing QC and a MetricSummary per metric are kept.
+    """
+
+    def __init__(self, bins: int = 100, compression: float = 100):
+        self.bins = bins
+        self.compression = compression
+        self.entries = {}
+
+    def _entry(self, key: Tuple[str, str, str]) -> Dict:
+        if key not in self.entries:
+            self.entries[key] = {'sites': 0, 'sites passing QC': 0, 'metrics': {}}
+        return self.entries[key]
+
+    def update(self, div: pd.DataFrame, sites: pd.Series,
+               context: str = '.', group: str = 'all') -> None:
+        """Add the results of a region block.
+
+        Args:
+            div: Per-site results as returned by est.js_divergence, indexed
+                by (#chrom, start, end)
+            sites: Number of sites read per chromosome, including those
+                that failed QC
+            context: Context label, e.g. the cytosine context (default: '.')
+            group: Group label (default: 'all')
+        """
+        for chrom, numsites in sites.items():
+            self._entry((str(chrom), context, group))['sites'] += int(numsites)
+
+        if div.empty:
+            return
+
+        chroms = div.index.get_level_values('#chrom')
+        unique = pd.unique(chroms)
+        for chrom in unique:
+            rows = div[chroms == chrom] if len(unique) > 1 else div
+            entry = self._entry((str(chrom), context, group))
+            entry['sites passing QC'] += len(rows)
+            for column in filter(is_metric, rows.columns):
+                if column not in entry['metrics']:
+                    entry['metrics'][column] = MetricSummary(
+                        self.bins, self.compression)
+                entry['metrics'][column].update(rows[column].to_numpy())
+
+    def merge(self, other: 'Summary') -> None:
+        """Add the entries of other, e.g. of another worker."""
+        for key, other_entry in other.entries.items():
+            entry = self._entry(key)
+            entry['sites'] += other_entry['sites']
+            entry['sites passing QC'] += other_entry['sites passing QC']
+            for column, metric in other_entry['metrics'].items():
+                if column in entry['metrics']:
+                    entry['metrics'][column].merge(metric)
+                else:
+                    entry['metrics'][column] = metric
+
+    def table(self) -> pd.DataFrame:
+        """Return one row per key and metric with moments and quantiles.
+
+        Keys without sites passing QC get a single row with metric '.', so
+        that their site counts are reported as well.
+        """
+        rows = []
+        for (chrom, context, group), entry in sorted(self.entries.items()):
+            if not entry['metrics']:
+                rows.append({'#chrom': chrom, 'context': context, 'group': group,
+                             'metric': '.', 'sites': entry['sites'],
+                             'sites passing QC': entry['sites passing QC'],
+                             'n': 0})
+            for column, metric in entry['metrics'].items():
+                moments = metric.moments
+                row = {'#chrom': chrom, 'context': context, 'group': group,
+                       'metric': column, 'sites': entry['sites'],
+                       'sites passing QC': entry['sites passing QC'],
+                       'n': moments.n, 'mean': moments.mean if moments.n else np.nan,
+                       'sd': moments.sd,
+                       'min': moments.min if moments.n else np.nan}
+                for q in QUANTILES:
+                    row[f'q{round(100 * q):02d}'] = metric.digest.quantile(q)
+                row['max'] = moments.max if moments.n else np.nan
+                rows.append(row)
+        return pd.DataFrame(rows)
+
+    def to_dict(self) -> Dict:
+        return {'bins': self.bins, 'compression': self.compression,
+                'entries': [{'chrom': chrom, 'context': context, 'group': group,
+                             'sites': entry['sites'],
+                             'sites passing QC': entry['sites passing QC'],
+                             'metrics': {column: metric.to_dict()
+                                         for column, metric in entry['metrics'].items()}}
+                            for (chrom, context, group), entry in self.entries.items()]}
+
+    @classmethod
+    def from_dict(cls, state: Dict) -> 'Summary':
+        summary = cls(state['bins'], state['compression'])
+        for item in state['entries']:
+            entry = summary._entry((item['chrom'], item['context'], item['group']))
+            entry['sites'] = item['sites']
+            entry['sites passing QC'] = item['sites passing QC']
+            entry['metrics'] = {column: MetricSummary.from_dict(metric)
+                                for column, metric in item['metrics'].items()}
+        return summary
+
+
+def write_summary(summary: Summary, outfile: str, decimals: int = 3) -> None:
+    """Write the summary table to outfile and its state to outfile.json.
+
+    The table is tab-separated with the metric values rounded; the JSON
+    state holds the accumulators, which read_summary restores for merging.
+
+    Args:
+        summary: Summary to write
+        outfile: Output file path
+        decimals: Decimals of the metric values in the table (default: 3)
+
+    Raises:
+        IOError: If output files cannot be written
+    """
+    try:
+        table = summary.table()
+        values = [column for column in table.columns
+                  if column in ('mean', 'sd', 'min', 'max') or column.startswith('q')]
+        table.round({column: decimals for column in values}).to_csv(
+            outfile, sep='\t', index=False)
+        with open(outfile + '.json', 'w') as handle:
+            json.dump(summary.to_dict(), handle)
+        logger.debug(f"Summary written to {outfile}")
+    except IOError as e:
+        logger.error(f"Failed to write summary {outfile}: {e}")
+        raise
+
+
+def read_summary(infile: str) -> Summary:
+    """Read a summary written by write_summary.
+
+    Args:
+        infile: Summary table path (its state is read from infile.json) or
+            the path of the JSON state itself
+
+    Returns:
+        Summary
+    """
+    statefile = infile if infile.endswith('.json') else infile + '.json'
+    try:
+        with open(statefile) as handle:
+            return Summary.from_dict(json.load(handle))
+    except FileNotFoundError:
+        logger.error(f"Summary state not found: {statefile}")
+        raise
+
+
+def merge_summaries(infiles: List[str], outfile: Optional[str] = None) -> Summary:
+    """Merge the summaries of several workers.
+
+    Args:
+        infiles: Summary files, see read_summary
+        outfile: Output file path of the merged summary (optional)
+
+    Returns:
+        Merged summary
+    """
+    summary = read_summary(infiles[0])
+    for infile in infiles[1:]:
+        summary.merge(read_summary(infile))
+
+    if outfile is not None:
+        write_summary(summary, outfile)
+
+    return summary
@@ -0,0 +1,42 @@
+# -*- coding:utf-8 -*-
+# test_decomposition.py
+
+"""Checks of the JS divergence decomposition over nested groups."""
+
+import numpy as np
+import pytest
+
+import shannonlib.estimators as est
+import shannonlib.gpf_utils as gpf
+
+
+UNITS = [f'u{i}' for i in range(8)]
+GROUPS = {'eco': dict(zip(UNITS, 'AAAABBBB')),
+          'tissue': dict(zip(UNITS, 'rrllrrll'))}
+
+
+def random_sites(numsites=500, seed=0):
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(0, 40, (numsites, len(UNITS), 2)).astype(np.float64)
+    valid = rng.random((numsites, len(UNITS))) > 0.2
+    counts[~valid] = 0
+    return gpf.SiteArray(
+        np.full(numsites, '1', dtype=object), np.arange(numsites),
+        np.arange(numsites), counts, valid, UNITS, ['mC', 'C'])
+
+
+@pytest.mark.parametrize('weights', [None, 'uniform', np.linspace(1, 2, 8)])
+def test_parts_sum_to_total(weights):
+    div = est.js_divergence(random_sites(), weights=weights,
+                            metrics=est.METRICS, groups=GROUPS)
+    parts = div[['JSD_between_eco_bit_', 'JSD_between_tissue_bit_',
+                 'JSD_within_bit_']].sum(axis=1)
+    assert len(div) > 0
+    np.testing.assert_allclose(parts, div['JSD_bit_'], rtol=0, atol=1e-12)
+
+
+def test_decomposition_does_not_change_metrics():
+    data = random_sites()
+    plain = est.js_divergence(data, metrics=est.METRICS)
+    grouped = est.js_divergence(data, metrics=est.METRICS, groups=GROUPS)
+    assert grouped[plain.columns].equals(plain)
@@ -0,0 +1,53 @@
+# -*- coding:utf-8 -*-
+# test_merge_sites.py
+
+"""Checks of the sorted engine merge against the concat engine."""
+
+import numpy as np
+import pandas as pd
+
+import shannonlib.gpf_utils as gpf
+
+
+COLUMNS = [(0, '#chrom', str), (1, 'start', np.int64), (2, 'end', np.int64),
+           (4, 'mC', int), (5, 'C', int)]
+INDEX_COL = [0, 1, 2]
+FEATURES = ['mC', 'C']
+
+
+def merge_both(raws, chroms):
+    arrays = [gpf.parse_bed(raw, COLUMNS) for raw in raws]
+    units = [f'u{i}' for i in range(len(raws))]
+    frames = pd.concat([gpf.bed_frame(a, COLUMNS, INDEX_COL) for a in arrays],
+                       axis=1, keys=units, join='outer')
+    sites = gpf.merge_sites([gpf.read_sites(a, chroms) for a in arrays],
+                            units, FEATURES, chroms)
+    return frames, sites
+
+
+def test_large_spans_and_positions():
+    raws = [b'1\t10\t10\t0\t1\t2\n1\t20\t6000\t0\t3\t4\n',
+            b'1\t20\t6000\t0\t5\t6\n1\t5000000000\t5000000000\t0\t1\t1\n']
+    frames, sites = merge_both(raws, ['1'])
+    assert len(sites.start) == len(frames) == 3
+    assert sites.valid.all(axis=0).tolist() == [False, False]
+    assert sites.valid.sum() == 4
+    assert list(sites.end) == [10, 6000, 5000000000]
+
+
+def test_unqueried_chromosomes_are_kept():
+    chroms = ['2', '10']
+    raws = [b'2\t5\t5\t0\t1\t2\n10\t3\t3\t0\t1\t1\n',
+            b'10\t3\t3\t0\t2\t2\nX\t1\t1\t0\t1\t1\n']
+    frames, sites = merge_both(raws, chroms)
+    assert list(sites.chrom) == ['2', '10', 'X']
+    assert chroms == ['2', '10', 'X']
+    assert sites.valid.sum() == frames.notna().T.groupby(level=0).any().sum().sum()
+
+
+def test_missing_samples():
+    arrays = gpf.parse_bed(b'1\t5\t5\t0\t1\t2\n', COLUMNS)
+    sites = gpf.merge_sites([None, gpf.read_sites(arrays, ['1'])],
+                            ['u0', 'u1'], FEATURES, ['1'], min_samplesize=1)
+    assert sites.valid.tolist() == [[False, True]]
+    assert sites.counts[0, 1].tolist() == [1, 2]
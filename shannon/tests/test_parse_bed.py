@@ -0,0 +1,90 @@
+# -*- coding:utf-8 -*-
+# test_parse_bed.py
+
+"""Regression checks of gpf_utils.parse_bed against pd.read_table."""
+
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import shannonlib.gpf_utils as gpf
+
+
+COLUMNS = [(0, '#chrom', str), (1, 'start', np.int64), (2, 'end', np.int64),
+           (4, 'mC', int), (5, 'C', int)]
+INDEX_COL = [0, 1, 2]
+
+
+def read_table(raw):
+    return pd.read_table(io.BytesIO(raw), header=None, index_col=INDEX_COL,
+                         comment='#', usecols=[c[0] for c in COLUMNS],
+                         names=[c[1] for c in COLUMNS],
+                         dtype={c[1]: c[2] for c in COLUMNS})
+
+
+def random_records(numrec, seed=0):
+    rng = np.random.default_rng(seed)
+    start = np.sort(rng.choice(10**9, numrec, replace=False))
+    coverage = rng.integers(0, 10**rng.integers(1, 6, numrec))
+    mc = rng.binomial(coverage, 0.4)
+    chrom = rng.choice(['1', '12', 'chrX'], numrec)
+    return ''.join(f'{c}\t{s}\t{s}\t{100 * m / max(n, 1):.3f}\t{m}\t{n - m}\n'
+                   for c, s, m, n in zip(chrom, start, mc, coverage)).encode()
+
+
+@pytest.mark.parametrize('raw', [
+    random_records(2000),
+    b'1\t5\t5\t0\t1\t2\n1\t70\t70\t0\t123\t4\n',
+    b'#header\n1\t5\t5\t0\t1\t2\n# comment\n12\t7\t7\t0\t3\t45\n',
+    b'1\t5\t5\t0\t1\t2\n1\t9\t9\t0\t0\t1234567890123',
+    b'chr1\t1234567890123\t1234567890123\t0\t0\t99\n',
+    # CRLF line endings, also without a final newline
+    b'1\t5\t5\t0\t1\t2\r\n1\t70\t70\t0\t123\t4\r\n',
+    b'1\t5\t5\t0\t1\t2\r\n1\t70\t70\t0\t123\t4\r',
+])
+def test_matches_read_table(raw):
+    expected = read_table(raw)
+    assert gpf.bed_frame(gpf.parse_bed(raw, COLUMNS), COLUMNS, INDEX_COL).equals(expected)
+
+
+def test_read_bed_falls_back_to_read_table():
+    raw = b'1\t 5\t5\t0\t 1\t2\n1\t6\t6\t0\t3\t4\n'
+    with pytest.raises(ValueError):
+        gpf.parse_bed(raw, COLUMNS)
+    expected = read_table(raw)
+    assert gpf.bed_frame(gpf.read_bed(raw, COLUMNS), COLUMNS, INDEX_COL).equals(expected)
+
+
+def test_error_quotes_malformed_record():
+    with pytest.raises(ValueError, match="1a3"):
+        gpf.parse_bed(b'1\t5\t5\t0\t1\t2\n1\t6\t6\t0\t1a3\t2\n', COLUMNS)
+
+
+def test_empty_input():
+    for raw in [b'', b'\n', b'#only a comment\n']:
+        arrays = gpf.parse_bed(raw, COLUMNS)
+        assert all(len(array) == 0 for array in arrays.values())
+
+
+@pytest.mark.parametrize('raw', [
+    # non-digit inside a field that is wider than others in the column
+    b'1\t5\t5\t0\t1a3\t2\n1\t6\t6\t0\t1\t2\n',
+    b'1\t5\t5\t0\tx\t2\n',
+    # empty field
+    b'1\t5\t5\t0\t\t2\n',
+    # ragged records, also when the total number of fields fits
+    b'1\t5\t5\t0\t1\t2\n1\t6\t6\t0\t1\n',
+    b'1\t5\t5\t0\t1\n1\t6\t6\t0\t1\t2\t3\n',
+])
+def test_rejects_malformed_input(raw):
+    with pytest.raises(ValueError):
+        read_table(raw).astype(np.int64)
+    with pytest.raises(ValueError):
+        gpf.parse_bed(raw, COLUMNS)
+
+
+def test_rejects_negative_counts():
+    with pytest.raises(ValueError):
+        gpf.parse_bed(b'1\t5\t5\t0\t-3\t2\n1\t6\t6\t0\t12\t2\n', COLUMNS)
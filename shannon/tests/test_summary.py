@@ -0,0 +1,27 @@
+# -*- coding:utf-8 -*-
+# test_summary.py
+
+"""Checks of the metric summaries."""
+
+import numpy as np
+import pandas as pd
+
+import shannonlib.summary as smry
+
+
+def test_histogram_bounds():
+    histogram = smry.Histogram(bins=10)
+    histogram.update(np.array([-1.6e-16, 0.5, 1 + 1e-15, -0.1, 1.2]))
+    assert (histogram.underflow, histogram.overflow) == (1, 1)
+    assert histogram.counts[0] == histogram.counts[-1] == 1
+
+
+def test_table_reports_keys_without_sites_passing_qc():
+    index = pd.MultiIndex.from_tuples([('1', 5, 5)], names=['#chrom', 'start', 'end'])
+    summary = smry.Summary()
+    summary.update(pd.DataFrame({'JSD_bit_': [0.1], 'sample size': [2]}, index=index),
+                   pd.Series({'1': 3, '2': 4}))
+    table = summary.table().set_index(['#chrom', 'metric'])
+    assert table.loc[('1', 'JSD_bit_'), 'sites passing QC'] == 1
+    assert table.loc[('2', '.'), 'sites'] == 4
+    assert table.loc[('2', '.'), 'sites passing QC'] == 0